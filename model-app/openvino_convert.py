@@ -30,41 +30,28 @@
 # distributed under the BSD 3-Clause License.
 # https://github.com/pytorch/examples/blob/master/LICENSE
 
-import os
 import sys
-import subprocess
 
+import openvino
 import torch
-from server.transformer_net import TransformerNet
+
+sys.path.append(".")
+from server.openrtist.transformer_net import TransformerNet  # noqa: E402
+
+# Input size of the IR. The server reshapes it when it runs other sizes
+INPUT_SHAPE = [1, 3, 240, 320]
 
 
 def convert(model):
     model_out = model if not model.endswith(".model") else model[:-6]
     style_model = TransformerNet()
     style_model.load_state_dict(torch.load(model))
-    dummy_input = torch.randn(1, 3, 240, 320)
-    input_names = ["Input"]
-    output_names = ["Output"]
-    torch.onnx.export(
-        style_model,
-        dummy_input,
-        "tmp.onnx",
-        verbose=False,
-        input_names=input_names,
-        output_names=output_names,
-    )
-    subprocess.call(
-        [
-            "/opt/intel/openvino/deployment_tools/model_optimizer/mo_onnx.py",
-            "--input_model",
-            "tmp.onnx",
-            "--data_type",
-            "FP16",
-            "--model_name",
-            model_out,
-        ]
+    style_model.eval()
+    ov_model = openvino.convert_model(
+        style_model, example_input=torch.randn(INPUT_SHAPE), input=[INPUT_SHAPE]
     )
-    os.remove("tmp.onnx")
+    # Writes model_out.xml and model_out.bin, with FP16 weights
+    openvino.save_model(ov_model, model_out + ".xml", compress_to_fp16=True)
 
 
 if __name__ == "__main__":
@@ -72,8 +59,8 @@ if __name__ == "__main__":
         print("Use to convert pytorch .model files to openvino .xml and .bin files")
         print("Usage:  convert file1.model [file2.model ...]")
         print(
-            "   Note: requires opentorch, openvino, and onnx prerequisites "
-            "for openvino are installed"
+            "   Note: requires torch and openvino 2023.1 or later, which "
+            "provides openvino.convert_model"
         )
     else:
         for model in sys.argv[1:]:
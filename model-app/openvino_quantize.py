@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+
+import cv2
+import nncf
+import numpy as np
+import openvino
+
+try:
+    from openvino import Core
+except ImportError:
+    # Releases before 2023.1
+    from openvino.runtime import Core
+
+MAX_IMAGES = 300
+
+# The IR that styles without a <style>.xml of their own share, as in
+# OpenvinoAdapter
+SHARED_XML = "16.xml"
+
+
+def load_frames(frames_dir, width, height):
+    """Images in frames_dir, preprocessed like OpenvinoAdapter's input."""
+    frames = []
+    for name in sorted(os.listdir(frames_dir)):
+        img = cv2.imread(os.path.join(frames_dir, name))
+        if img is None:
+            continue
+        img = cv2.cvtColor(cv2.resize(img, (width, height)), cv2.COLOR_BGR2RGB)
+        img = np.float32(img.transpose((2, 0, 1))) * (1.0 / 255.0)
+        frames.append(img[np.newaxis])
+        if len(frames) == MAX_IMAGES:
+            break
+    return frames
+
+
+def save_model(model, xml):
+    if hasattr(openvino, "save_model"):
+        openvino.save_model(model, xml, compress_to_fp16=False)
+    else:
+        # Releases before 2023.0
+        from openvino.runtime import serialize
+
+        serialize(model, xml)
+
+
+def run(core, model, frames):
+    """Outputs for frames on the CPU, and the mean latency in seconds."""
+    compiled = core.compile_model(model, "CPU")
+    request = compiled.create_infer_request()
+    request.infer({0: frames[0]})
+
+    outputs = []
+    start = time.time()
+    for frame in frames:
+        request.infer({0: frame})
+        outputs.append(np.clip(request.get_output_tensor(0).data, 0, 255))
+    return outputs, (time.time() - start) / len(frames)
+
+
+def model_files(path):
+    """(.xml, .bin) for a style's .bin or .xml. A style's weights are read
+    with its own <style>.xml if there is one, and otherwise with the shared
+    16.xml in the same directory."""
+    base = os.path.splitext(path)[0]
+    weights = base + ".bin"
+    xml = base + ".xml"
+    if not os.path.isfile(xml):
+        xml = os.path.join(os.path.dirname(path), SHARED_XML)
+    return xml, weights
+
+
+def quantize(core, path, frames_dir):
+    if path.endswith((".int8.xml", ".int8.bin")):
+        return
+    xml, weights = model_files(path)
+    out_xml = weights[: -len(".bin")] + ".int8.xml"
+
+    model = core.read_model(model=xml, weights=weights)
+    _, _, height, width = model.input(0).get_shape()
+    frames = load_frames(frames_dir, width, height)
+    if not frames:
+        print("No images in {}".format(frames_dir))
+        sys.exit(1)
+
+    quantized = nncf.quantize(
+        model,
+        nncf.Dataset(frames),
+        preset=nncf.QuantizationPreset.PERFORMANCE,
+        subset_size=len(frames),
+    )
+    save_model(quantized, out_xml)
+
+    expected, latency = run(core, model, frames)
+    actual, int8_latency = run(core, quantized, frames)
+    psnrs = []
+    for e, a in zip(expected, actual):
+        mse = np.mean((e - a) ** 2)
+        psnrs.append(10 * np.log10(255**2 / max(mse, 1e-10)))
+
+    print("Wrote {}".format(out_xml))
+    print(
+        "  latency {:.1f} ms -> {:.1f} ms ({:.2f}x speedup)".format(
+            1000 * latency, 1000 * int8_latency, latency / int8_latency
+        )
+    )
+    print(
+        "  PSNR against the original IR: mean {:.1f} dB, min {:.1f} dB".format(
+            np.mean(psnrs), np.min(psnrs)
+        )
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Use to quantize openvino .xml and .bin files to INT8")
+        print("Usage:  quantize frames_dir style1.bin [style2.bin ...]")
+        print(
+            "   Writes style1.int8.xml and style1.int8.bin next to each input. "
+            "Each style is read with style1.xml if it exists, and otherwise "
+            "with the 16.xml next to it. "
+            "frames_dir holds images like the frames that clients send, used "
+            "for calibration and for measuring latency and quality"
+        )
+        print("   Note: requires openvino and nncf to be installed")
+    else:
+        core = Core()
+        for path in sys.argv[2:]:
+            quantize(core, path, sys.argv[1])
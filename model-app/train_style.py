@@ -43,11 +43,17 @@ from torch.utils.data import DataLoader
 from torchvision import datasets
 from torchvision import transforms
 from torchvision import models
-from server import utils
-from server.transformer_net import TransformerNet
 import numpy as np
+import sys
 from collections import namedtuple
 
+sys.path.append(".")
+from server.openrtist import utils  # noqa: E402
+from server.openrtist.transformer_net import (  # noqa: E402
+    StyleBankTransformerNet,
+    TransformerNet,
+)
+
 
 class Vgg16(torch.nn.Module):
     def __init__(self, requires_grad=False):
@@ -190,6 +196,14 @@ def get_args():
         help="number of batches after which a checkpoint of the trained model "
         "will be created",
     )
+    parser.add_argument(
+        "--teachers",
+        type=str,
+        nargs="+",
+        default=None,
+        help="trained .model files to distill into a single style bank, "
+        "style_bank.pt, instead of training a style from --style-image",
+    )
 
     return parser.parse_args()
 
@@ -336,6 +350,121 @@ def train(args, progress_callback):
     return save_model_filename
 
 
+def distill(args, progress_callback):
+    """Train a StyleBankTransformerNet to match each of the TransformerNets
+    in args.teachers for its style. Each sample of a batch gets a random
+    style, and the loss compares the student's output with the teacher's in
+    pixels and in VGG features."""
+    device = torch.device("cuda")
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    transform = transforms.Compose(
+        [
+            transforms.Resize(args.image_size),
+            transforms.CenterCrop(args.image_size),
+            transforms.ToTensor(),
+            transforms.Lambda(lambda x: x.mul(255)),
+        ]
+    )
+    train_dataset = datasets.ImageFolder(args.dataset, transform)
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size)
+
+    styles = []
+    teachers = []
+    state_dicts = []
+    for teacher_path in args.teachers:
+        styles.append(os.path.basename(teacher_path).split(".")[0])
+        state_dicts.append(torch.load(teacher_path))
+        teacher = TransformerNet()
+        teacher.load_state_dict(state_dicts[-1])
+        teachers.append(teacher.to(device).eval())
+
+    # Starting from the teachers' own instance norms, only the shared
+    # convolutions have far to go
+    transformer = StyleBankTransformerNet(len(styles))
+    transformer.load_transformer_nets(state_dicts)
+    transformer.to(device)
+    optimizer = Adam(transformer.parameters(), args.lr)
+    mse_loss = torch.nn.MSELoss()
+
+    vgg = Vgg16(requires_grad=False).to(device)
+
+    for e in range(args.epochs):
+        transformer.train()
+        agg_pixel_loss = 0.0
+        agg_feature_loss = 0.0
+        count = 0
+        for batch_id, (x, _) in enumerate(train_loader):
+            n_batch = len(x)
+            count += n_batch
+
+            optimizer.zero_grad()
+
+            x = x.to(device)
+            style_index = torch.randint(len(styles), (n_batch,), device=device)
+            with torch.no_grad():
+                target = torch.empty_like(x)
+                for index, teacher in enumerate(teachers):
+                    mask = style_index == index
+                    if mask.any():
+                        target[mask] = teacher(x[mask])
+            y = transformer(x, style_index)
+
+            y = utils.normalize_batch(y)
+            target = utils.normalize_batch(target)
+
+            pixel_loss = mse_loss(y, target)
+            feature_loss = 0.0
+            for ft_y, ft_target in zip(vgg(y), vgg(target)):
+                feature_loss += mse_loss(ft_y, ft_target)
+
+            total_loss = pixel_loss + feature_loss
+            total_loss.backward()
+            optimizer.step()
+
+            agg_pixel_loss += pixel_loss.item()
+            agg_feature_loss += feature_loss.item()
+
+            if (batch_id + 1) % args.log_interval == 0:
+                progress_callback(
+                    e,
+                    args.epochs,
+                    count,
+                    len(train_dataset),
+                    agg_pixel_loss / (batch_id + 1),
+                    agg_feature_loss / (batch_id + 1),
+                )
+
+            if (
+                args.checkpoint_model_dir is not None
+                and (batch_id + 1) % args.checkpoint_interval == 0
+            ):
+                transformer.eval().cpu()
+                ckpt_model_filename = "ckpt_bank_epoch_{}_batch_id_{}.pt".format(
+                    e, batch_id + 1
+                )
+                ckpt_model_path = os.path.join(
+                    args.checkpoint_model_dir, ckpt_model_filename
+                )
+                torch.save(
+                    {"styles": styles, "state_dict": transformer.state_dict()},
+                    ckpt_model_path,
+                )
+                transformer.to(device).train()
+
+    # save model
+    transformer.eval().cpu()
+    save_model_filename = "style_bank.pt"
+    save_model_path = os.path.join(args.save_model_dir, save_model_filename)
+    torch.save(
+        {"styles": styles, "state_dict": transformer.state_dict()}, save_model_path
+    )
+
+    print("\nDone, style bank saved at", save_model_path)
+    return save_model_filename
+
+
 def log_progress(epoch, num_epochs, count, num_images, content, style, flicker, total):
     mesg = (
         "{}\tEpoch {}:\t[{}/{}]\tcontent: {:.6f}\tstyle: {:.6f}\t"
@@ -346,12 +475,22 @@ def log_progress(epoch, num_epochs, count, num_images, content, style, flicker,
     print(mesg)
 
 
+def log_distill_progress(epoch, num_epochs, count, num_images, pixel, feature):
+    mesg = "{}\tEpoch {}:\t[{}/{}]\tpixel: {:.6f}\tfeature: {:.6f}".format(
+        time.ctime(), epoch + 1, count, num_images, pixel, feature
+    )
+    print(mesg)
+
+
 def main():
     assert torch.cuda.is_available(), "Cuda is not available"
 
     args = get_args()
     check_paths(args)
-    train(args, log_progress)
+    if args.teachers:
+        distill(args, log_distill_progress)
+    else:
+        train(args, log_progress)
 
 
 if __name__ == "__main__":
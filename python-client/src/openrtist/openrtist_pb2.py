@@ -15,13 +15,15 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0fopenrtist.proto\x12\topenrtist\"\x99\x02\n\x06\x45xtras\x12\r\n\x05style\x18\x01 \x01(\t\x12\x34\n\nstyle_list\x18\x02 \x03(\x0b\x32 .openrtist.Extras.StyleListEntry\x12\x31\n\x0bstyle_image\x18\x03 \x01(\x0b\x32\x1c.openrtist.Extras.BytesValue\x12\x17\n\x0f\x64\x65pth_threshold\x18\x04 \x01(\x05\x12/\n\tdepth_map\x18\x05 \x01(\x0b\x32\x1c.openrtist.Extras.BytesValue\x1a\x1b\n\nBytesValue\x12\r\n\x05value\x18\x01 \x01(\x0c\x1a\x30\n\x0eStyleListEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01\x42\x1e\n\x14\x65\x64u.cmu.cs.openrtistB\x06Protosb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0fopenrtist.proto\x12\topenrtist\"\x85\x05\n\x06\x45xtras\x12\r\n\x05style\x18\x01 \x01(\t\x12\x34\n\nstyle_list\x18\x02 \x03(\x0b\x32 .openrtist.Extras.StyleListEntry\x12\x31\n\x0bstyle_image\x18\x03 \x01(\x0b\x32\x1c.openrtist.Extras.BytesValue\x12\x17\n\x0f\x64\x65pth_threshold\x18\x04 \x01(\x05\x12/\n\tdepth_map\x18\x05 \x01(\x0b\x32\x1c.openrtist.Extras.BytesValue\x12-\n\x0coutput_codec\x18\x06 \x01(\x0e\x32\x17.openrtist.Extras.Codec\x12\x16\n\x0eoutput_quality\x18\x07 \x01(\x05\x12\x46\n\x19output_chroma_subsampling\x18\x08 \x01(\x0e\x32#.openrtist.Extras.ChromaSubsampling\x12\x14\n\x0coutput_width\x18\t \x01(\x05\x12\x15\n\routput_height\x18\n \x01(\x05\x12\x17\n\x0finference_scale\x18\x0b \x01(\x02\x1a\x1b\n\nBytesValue\x12\r\n\x05value\x18\x01 \x01(\x0c\x1a\x30\n\x0eStyleListEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01\"(\n\x05\x43odec\x12\x08\n\x04JPEG\x10\x00\x12\x08\n\x04WEBP\x10\x01\x12\x0b\n\x07RAW_RGB\x10\x02\"k\n\x11\x43hromaSubsampling\x12\x17\n\x13\x44\x45\x46\x41ULT_SUBSAMPLING\x10\x00\x12\x13\n\x0fSUBSAMPLING_420\x10\x01\x12\x13\n\x0fSUBSAMPLING_422\x10\x02\x12\x13\n\x0fSUBSAMPLING_444\x10\x03\x42\x1e\n\x14\x65\x64u.cmu.cs.openrtistB\x06Protosb\x06proto3')
 
 
 
 _EXTRAS = DESCRIPTOR.message_types_by_name['Extras']
 _EXTRAS_BYTESVALUE = _EXTRAS.nested_types_by_name['BytesValue']
 _EXTRAS_STYLELISTENTRY = _EXTRAS.nested_types_by_name['StyleListEntry']
+_EXTRAS_CODEC = _EXTRAS.enum_types_by_name['Codec']
+_EXTRAS_CHROMASUBSAMPLING = _EXTRAS.enum_types_by_name['ChromaSubsampling']
 Extras = _reflection.GeneratedProtocolMessageType('Extras', (_message.Message,), {
 
   'BytesValue' : _reflection.GeneratedProtocolMessageType('BytesValue', (_message.Message,), {
@@ -52,9 +54,13 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _EXTRAS_STYLELISTENTRY._options = None
   _EXTRAS_STYLELISTENTRY._serialized_options = b'8\001'
   _EXTRAS._serialized_start=31
-  _EXTRAS._serialized_end=312
-  _EXTRAS_BYTESVALUE._serialized_start=235
-  _EXTRAS_BYTESVALUE._serialized_end=262
-  _EXTRAS_STYLELISTENTRY._serialized_start=264
-  _EXTRAS_STYLELISTENTRY._serialized_end=312
+  _EXTRAS._serialized_end=676
+  _EXTRAS_BYTESVALUE._serialized_start=448
+  _EXTRAS_BYTESVALUE._serialized_end=475
+  _EXTRAS_STYLELISTENTRY._serialized_start=477
+  _EXTRAS_STYLELISTENTRY._serialized_end=525
+  _EXTRAS_CODEC._serialized_start=527
+  _EXTRAS_CODEC._serialized_end=567
+  _EXTRAS_CHROMASUBSAMPLING._serialized_start=569
+  _EXTRAS_CHROMASUBSAMPLING._serialized_end=676
 # @@protoc_insertion_point(module_scope)
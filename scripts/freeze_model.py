@@ -35,18 +35,52 @@ python scripts/freeze_model.py freeze \
 --output-file-path='starry-night.pt'
 ```
 
-Note: Quantize doesn't seem to have an effect as openrtist does not contain
-fully connected layer.
+To export a model for the ONNX Runtime adapter (server/main.py --onnx), write
+it to the server's models directory:
+
+```python
+python scripts/freeze_model.py export_onnx \
+--weight-file-path='models/starry-night.model' \
+--output-file-path='server/models/starry-night.onnx'
+```
+
+Note: quantize_and_freeze doesn't seem to have an effect as openrtist does not
+contain fully connected layer. quantize_static quantizes the convolutions
+instead, calibrated on a directory of sample frames. Its output, written next
+to the weights in the server's models directory, is used by server/main.py
+--int8:
+
+```python
+python scripts/freeze_model.py quantize_static \
+--weight-file-path='server/models/starry-night.model' \
+--output-file-path='server/models/starry-night.int8.pt' \
+--calibration-dir='frames'
+```
+
+FX graph mode quantization requires Pytorch 1.8 or later.
 """
 
+import copy
+import inspect
+import os
+import time
 import cv2
 import fire
+import numpy as np
 import torch
 from torchvision import transforms
 import sys
 
+try:
+    from torch.ao.quantization import get_default_qconfig
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+except ImportError:
+    # Releases before 1.10
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import convert_fx, prepare_fx
+
 sys.path.append(".")
-from server.transformer_net import TransformerNet  # noqa: E402
+from server.openrtist.transformer_net import TransformerNet  # noqa: E402
 
 
 class Tracer:
@@ -87,6 +121,105 @@ class Tracer:
         traced_model = torch.jit.trace(self._model, model_input)
         traced_model.save(output_file_path)
 
+    def export_onnx(
+        self,
+        weight_file_path="models/starry-night.model",
+        output_file_path="starry-night.onnx",
+        opset_version=13,
+    ):
+        """Export a pytorch weight file to ONNX, for the server's ONNX Runtime
+        adapter.
+
+        The batch size, height, and width of the input are left dynamic.
+        """
+        self._model.load_state_dict(torch.load(weight_file_path))
+        self._model.eval()
+        model_input = torch.rand(1, 3, 240, 320)
+        dynamic_axes = {0: "batch", 2: "height", 3: "width"}
+        torch.onnx.export(
+            self._model,
+            model_input,
+            output_file_path,
+            opset_version=opset_version,
+            input_names=["input"],
+            output_names=["output"],
+            dynamic_axes={"input": dynamic_axes, "output": dynamic_axes},
+        )
+
+    def quantize_static(
+        self,
+        weight_file_path="models/starry-night.model",
+        output_file_path="starry-night.int8.pt",
+        calibration_dir="frames",
+        width=640,
+        height=480,
+        max_images=32,
+    ):
+        """Quantize the convolutions of a pytorch weight file to INT8 and
+        freeze it with TorchScript, for the server's TorchAdapter on x86 CPUs.
+
+        Activation ranges are calibrated on up to max_images images from
+        calibration_dir, resized to width by height. These should look like
+        the frames that clients send. The speedup and PSNR of the quantized
+        model against float32 are measured on the same images.
+        """
+        torch.set_grad_enabled(False)
+        engines = torch.backends.quantized.supported_engines
+        engine = "x86" if "x86" in engines else "fbgemm"
+        torch.backends.quantized.engine = engine
+
+        self._model.load_state_dict(torch.load(weight_file_path))
+        self._model.eval()
+
+        images = _load_calibration_images(calibration_dir, width, height, max_images)
+        if not images:
+            raise ValueError("No images in {}".format(calibration_dir))
+
+        qconfig_dict = {"": get_default_qconfig(engine)}
+        if "example_inputs" in inspect.signature(prepare_fx).parameters:
+            prepared = prepare_fx(
+                copy.deepcopy(self._model), qconfig_dict, (images[0],)
+            )
+        else:
+            prepared = prepare_fx(copy.deepcopy(self._model), qconfig_dict)
+        for image in images:
+            prepared(image)
+        quantized = convert_fx(prepared)
+
+        traced_model = torch.jit.freeze(torch.jit.trace(quantized, images[0]))
+        traced_model.save(output_file_path)
+
+        # Warm up both models, then compare them
+        self._model(images[0])
+        traced_model(images[0])
+        fp32_time = int8_time = 0.0
+        psnrs = []
+        for image in images:
+            start = time.time()
+            expected = self._model(image).clamp(0, 255)
+            fp32_time += time.time() - start
+
+            start = time.time()
+            actual = traced_model(image).clamp(0, 255)
+            int8_time += time.time() - start
+
+            mse = torch.mean((expected - actual) ** 2).item()
+            psnrs.append(10 * np.log10(255**2 / max(mse, 1e-10)))
+
+        print("Wrote {} ({} backend)".format(output_file_path, engine))
+        print(
+            "float32 {:.1f} ms, int8 {:.1f} ms per image: {:.2f}x speedup".format(
+                1000 * fp32_time / len(images),
+                1000 * int8_time / len(images),
+                fp32_time / int8_time,
+            )
+        )
+        print(
+            "PSNR against float32: mean {:.1f} dB, min {:.1f} dB".format(
+                np.mean(psnrs), np.min(psnrs)
+            )
+        )
+
     def verify_on_livestream(self, weight_file_path="models/starry-night.model"):
         self._model.load_state_dict(torch.load(weight_file_path))
         preprocess = transforms.Compose([transforms.ToTensor()])
@@ -107,5 +240,20 @@ class Tracer:
                 cv2.waitKey(1)
 
 
+def _load_calibration_images(calibration_dir, width, height, max_images):
+    """Images in calibration_dir as RGB tensors, like the server's input."""
+    preprocess = transforms.Compose([transforms.ToTensor()])
+    images = []
+    for name in sorted(os.listdir(calibration_dir)):
+        img = cv2.imread(os.path.join(calibration_dir, name))
+        if img is None:
+            continue
+        img = cv2.cvtColor(cv2.resize(img, (width, height)), cv2.COLOR_BGR2RGB)
+        images.append(preprocess(img).unsqueeze(0))
+        if len(images) == max_images:
+            break
+    return images
+
+
 if __name__ == "__main__":
     fire.Fire(Tracer)
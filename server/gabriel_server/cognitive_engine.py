@@ -24,3 +24,21 @@ class Engine(ABC):
 
         Return an instance of gabriel_pb2.ResultWrapper().'''
         pass
+
+    def handle_batch(self, input_frames, client_ids=None):
+        '''Process a list of gabriel_pb2.InputFrame().
+
+        client_ids, when given, holds a hashable identifier for the client
+        that sent each frame. Return a list with one
+        gabriel_pb2.ResultWrapper() per input frame, in the same order.
+        Engines that can share work between frames should override this.'''
+        return [self.handle(input_frame) for input_frame in input_frames]
+
+    def handle_batch_async(self, input_frames, callback, client_ids=None):
+        '''Start processing a list of gabriel_pb2.InputFrame(), and call
+        callback with the list of results that handle_batch would return.
+
+        callback may run on another thread. Engines that can work on the
+        next batch before this one is finished should override this. By
+        default the batch is processed before this returns.'''
+        callback(self.handle_batch(input_frames, client_ids))
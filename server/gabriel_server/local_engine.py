@@ -1,40 +1,432 @@
 import asyncio
+import functools
+import itertools
 import logging
 import multiprocessing
 import os
+import struct
+import threading
+from collections import OrderedDict
 from gabriel_protocol import gabriel_pb2
 from gabriel_server import cognitive_engine
 from gabriel_server.websocket_server import WebsocketServer
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
 
 logger = logging.getLogger(__name__)
 
+# frame_id of the input frame that a slot holds, or that its result is for
+_SLOT_HEADER = struct.Struct('!q')
+
+# Seconds to wait for a terminated engine process before killing it
+_JOIN_TIMEOUT = 5
+
 
 class LocalEngine():
 
     @staticmethod
-    def run(engine_factory, source_name, 
+    def run(engine_factory, source_name,
             input_queue_maxsize, port, num_tokens,
-            message_max_size=None):
-        engine_conn, server_conn = multiprocessing.Pipe()
+            message_max_size=None, batch_size=1, batch_timeout=0,
+            num_workers=1, affinity_key=None, affinity_capacity=1,
+            shm_slot_size=None, worker_setup=None, batches_per_worker=1):
+        '''Run the engine in separate processes and serve it over websockets.
 
-        local_server = _LocalServer(num_tokens, input_queue_maxsize, server_conn)
-        local_server.add_source_consumed(source_name)
+        With batch_size > 1, up to batch_size queued frames are handed to
+        engine.handle_batch() together, along with the address of the client
+        that sent each one. The server waits at most batch_timeout
+        seconds for a batch to fill up once the first frame has arrived.
+
+        num_workers engine processes are started, and each client gets
+        num_tokens per worker. When affinity_key is given, it is called with
+        each gabriel_pb2.InputFrame() and should return a hashable key (such
+        as the requested style). A batch goes to an idle worker that handled
+        its key recently, if there is one. Each worker remembers its
+        affinity_capacity most recent keys. Workers that die are replaced.
 
-        engine_process = multiprocessing.Process(
-            target=_run_engine, args=(engine_factory, engine_conn))
-        engine_process.start()
-        local_server.launch(port, message_max_size)
+        When shm_slot_size is set, frames and results travel between the
+        server and the engine processes through shared memory slots of that
+        many bytes, and the pipes only carry slot numbers and lengths. The
+        engine then gets InputFrameView objects, whose payloads are
+        memoryviews of the shared memory that stay valid until the engine
+        returns their results.
+        Frames that do not fit in a slot are sent over the pipe.
+
+        When worker_setup is given, each engine process calls it with the
+        index of its worker, from 0 to num_workers - 1, before it calls
+        engine_factory. A replacement process gets the index of the one it
+        replaces.
+
+        Each worker is sent up to batches_per_worker batches before the
+        first of them is finished. Engines see them through
+        handle_batch_async(), so engines that override it can work on one
+        batch while they finish the one before.'''
+        if shm_slot_size and shared_memory is None:
+            logger.warning('Shared memory needs Python 3.8 or newer. '
+                           'Sending frames over pipes instead.')
+            shm_slot_size = None
+
+        local_server = _LocalServer(
+            num_tokens * num_workers, input_queue_maxsize, engine_factory,
+            num_workers, batch_size, batch_timeout, affinity_key,
+            affinity_capacity, shm_slot_size, worker_setup, batches_per_worker)
+        local_server.add_source_consumed(source_name)
+        try:
+            local_server.launch(port, message_max_size)
+        finally:
+            local_server.close()
 
         raise Exception('Server stopped')
 
 
+class InputFrameView:
+    '''Takes the place of a gabriel_pb2.InputFrame() whose payloads are
+    still in shared memory.
+
+    payload_type and extras (a google.protobuf.Any) are the fields of the
+    input frame. payloads is a list of memoryviews.'''
+
+    def __init__(self, payload_type, extras, payloads):
+        self.payload_type = payload_type
+        self.extras = extras
+        self.payloads = payloads
+
+
+class _FrameRing:
+    '''Fixed-size slots in shared memory, used to pass frames between the
+    server and one engine process.
+
+    A slot holds a frame_id and then chunks of bytes: the raw payloads of a
+    message, followed by its other fields, serialized. Only the slot number
+    and the lengths of the chunks are sent over the pipe. The server writes
+    input frames to slots. The engine writes each result back into the slot
+    that its input came from.'''
+
+    def __init__(self, num_slots, slot_size, name=None):
+        if name is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=num_slots * slot_size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._num_slots = num_slots
+        self._slot_size = slot_size
+
+    def get_name(self):
+        return self._shm.name
+
+    def get_num_slots(self):
+        return self._num_slots
+
+    def get_slot_size(self):
+        return self._slot_size
+
+    def write(self, slot, frame_id, chunks):
+        '''Write to slot. Returns the lengths of the chunks, or None if
+        they do not fit.'''
+        lengths = [len(chunk) for chunk in chunks]
+        if _SLOT_HEADER.size + sum(lengths) > self._slot_size:
+            return None
+
+        buf = self._shm.buf
+        offset = slot * self._slot_size
+        _SLOT_HEADER.pack_into(buf, offset, frame_id)
+        offset += _SLOT_HEADER.size
+        for chunk, length in zip(chunks, lengths):
+            buf[offset:offset + length] = chunk
+            offset += length
+
+        return lengths
+
+    def read(self, slot, lengths):
+        '''Return the frame_id in slot, and memoryviews of its chunks.
+        The views see whatever is written to the slot next.'''
+        buf = self._shm.buf
+        offset = slot * self._slot_size
+        frame_id, = _SLOT_HEADER.unpack_from(buf, offset)
+        offset += _SLOT_HEADER.size
+        chunks = []
+        for length in lengths:
+            chunks.append(buf[offset:offset + length])
+            offset += length
+
+        return frame_id, chunks
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _pack_input_frame(ring, slot, frame_id, input_frame):
+    '''Return the item to send over the pipe for input_frame.
+
+    If input_frame fits in slot of ring, this is a tuple with slot and the
+    lengths of the chunks written to it: the payloads, and then an
+    InputFrame with the other fields. Otherwise it is the serialized
+    input_frame.'''
+    if ring is not None:
+        fields = gabriel_pb2.InputFrame()
+        fields.payload_type = input_frame.payload_type
+        if input_frame.HasField('extras'):
+            fields.extras.CopyFrom(input_frame.extras)
+        chunks = list(input_frame.payloads) + [fields.SerializeToString()]
+        lengths = ring.write(slot, frame_id, chunks)
+        if lengths is not None:
+            return slot, lengths
+
+    return input_frame.SerializeToString()
+
+
+def _unpack_input_frame(ring, item):
+    if isinstance(item, tuple):
+        slot, lengths = item
+        frame_id, chunks = ring.read(slot, lengths)
+        fields = gabriel_pb2.InputFrame()
+        # Protobuf parses bytes, not memoryviews
+        fields.ParseFromString(bytes(chunks[-1]))
+        return frame_id, InputFrameView(
+            fields.payload_type, fields.extras, chunks[:-1])
+
+    input_frame = gabriel_pb2.InputFrame()
+    input_frame.ParseFromString(item)
+    return None, input_frame
+
+
+def _pack_result_wrapper(ring, slot, frame_id, result_wrapper):
+    '''Like _pack_input_frame, for a result_wrapper whose input came in
+    through slot, or over the pipe when slot is None.'''
+    if slot is not None:
+        payloads = [result.payload for result in result_wrapper.results]
+        for result in result_wrapper.results:
+            result.ClearField('payload')
+        lengths = ring.write(
+            slot, frame_id, payloads + [result_wrapper.SerializeToString()])
+        if lengths is not None:
+            return slot, lengths
+
+        for result, payload in zip(result_wrapper.results, payloads):
+            result.payload = payload
+
+    return result_wrapper.SerializeToString()
+
+
+def _unpack_result_wrapper(ring, item):
+    result_wrapper = gabriel_pb2.ResultWrapper()
+    if isinstance(item, tuple):
+        slot, lengths = item
+        frame_id, chunks = ring.read(slot, lengths)
+        result_wrapper.ParseFromString(bytes(chunks[-1]))
+        for result, payload in zip(result_wrapper.results, chunks):
+            # The slot is reused by the next batch, and protobuf needs bytes
+            result.payload = bytes(payload)
+        return frame_id, result_wrapper
+
+    result_wrapper.ParseFromString(item)
+    return None, result_wrapper
+
+
+class _EngineWorker:
+    def __init__(self, index, engine_factory, affinity_capacity, ring,
+                 worker_setup, batch_size, batches_in_flight):
+        self._index = index
+        self._engine_factory = engine_factory
+        self._worker_setup = worker_setup
+        self._affinity_capacity = affinity_capacity
+        self._ring = ring
+        self._batch_size = batch_size
+        self._recent_keys = OrderedDict()
+        self._batches_in_flight = batches_in_flight
+        self._num_in_flight = 0
+        # Each batch in flight gets its own batch_size slots in the ring
+        self._free_groups = list(range(batches_in_flight))
+        self._batch_ids = itertools.count()
+        # Batch id -> future for the items that the engine sends back
+        self._pending = {}
+        self._reading = False
+        self._restart = None
+        self._conn = None
+        self._process = None
+
+    def start(self):
+        engine_conn, self._conn = multiprocessing.Pipe()
+        ring_args = (None if self._ring is None else
+                     (self._ring.get_num_slots(), self._ring.get_slot_size(),
+                      self._ring.get_name()))
+        self._process = multiprocessing.Process(
+            target=_run_engine,
+            args=(self._engine_factory, engine_conn, ring_args,
+                  self._worker_setup, self._index))
+        self._process.start()
+
+        # Only the engine process should hold this end, so that we get EOF on
+        # self._conn if the engine dies.
+        engine_conn.close()
+
+    async def restart(self):
+        '''Replace the engine process. Batches that fail together share one
+        restart.'''
+        if self._restart is None:
+            self._restart = asyncio.ensure_future(self._replace_process())
+        await asyncio.shield(self._restart)
+
+    async def _replace_process(self):
+        self._stop_reading()
+        # Batches still waiting on the old process would never get results
+        self._fail_pending(EOFError('Engine process is being replaced'))
+        self._conn.close()
+        if self._process.is_alive():
+            self._process.terminate()
+
+        # Joining blocks, so it must not run on the event loop that serves
+        # every client.
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._process.join, _JOIN_TIMEOUT)
+        if self._process.is_alive():
+            self._process.kill()
+            await loop.run_in_executor(None, self._process.join)
+        logger.info('Engine process %d exited with code %s',
+                    self._process.pid, self._process.exitcode)
+
+        self._recent_keys.clear()
+        self.start()
+        self._restart = None
+
+    def has_room(self):
+        '''Whether another batch can be sent to this worker now.'''
+        return (self._num_in_flight < self._batches_in_flight and
+                self._restart is None)
+
+    def get_num_in_flight(self):
+        return self._num_in_flight
+
+    def begin_batch(self):
+        self._num_in_flight += 1
+
+    def end_batch(self):
+        self._num_in_flight -= 1
+
+    def has_key(self, key):
+        return key in self._recent_keys
+
+    def record_key(self, key):
+        self._recent_keys[key] = None
+        self._recent_keys.move_to_end(key)
+        while len(self._recent_keys) > self._affinity_capacity:
+            self._recent_keys.popitem(last=False)
+
+    async def process(self, from_clients, client_ids):
+        '''Send the input frames from from_clients to the engine process and
+        wait for its results.
+
+        Raises EOFError or OSError if the engine process died.'''
+        group = self._free_groups.pop(0)
+        try:
+            first_slot = group * self._batch_size
+            batch_id = next(self._batch_ids)
+            future = asyncio.get_event_loop().create_future()
+            self._pending[batch_id] = future
+            try:
+                self._conn.send((batch_id, [
+                    _pack_input_frame(self._ring, first_slot + i,
+                                      from_client.frame_id,
+                                      from_client.input_frame)
+                    for i, from_client in enumerate(from_clients)], client_ids))
+            except OSError:
+                del self._pending[batch_id]
+                raise
+
+            self._start_reading()
+            items = await future
+
+            result_wrappers = []
+            for from_client, item in zip(from_clients, items):
+                frame_id, result_wrapper = _unpack_result_wrapper(
+                    self._ring, item)
+                if frame_id is not None and frame_id != from_client.frame_id:
+                    logger.error('Engine returned result for frame %d in the '
+                                 'slot for frame %d', frame_id,
+                                 from_client.frame_id)
+                    status = gabriel_pb2.ResultWrapper.Status.ENGINE_ERROR
+                    result_wrapper = (
+                        cognitive_engine.CognitiveEngine.create_result_wrapper(
+                            status))
+                result_wrappers.append(result_wrapper)
+
+            return result_wrappers
+        finally:
+            self._free_groups.append(group)
+
+    def _start_reading(self):
+        if not self._reading:
+            asyncio.get_event_loop().add_reader(
+                self._conn.fileno(), self._on_readable)
+            self._reading = True
+
+    def _stop_reading(self):
+        # The reader is only added while batches are in flight. Otherwise a
+        # pipe at EOF, from an idle engine that died, would wake the loop on
+        # every poll.
+        if self._reading:
+            asyncio.get_event_loop().remove_reader(self._conn.fileno())
+            self._reading = False
+
+    def _on_readable(self):
+        try:
+            while self._pending and self._conn.poll():
+                batch_id, items = self._conn.recv()
+                future = self._pending.pop(batch_id)
+                if not future.done():
+                    future.set_result(items)
+        except (EOFError, OSError) as e:
+            self._stop_reading()
+            self._fail_pending(e)
+            return
+
+        if not self._pending:
+            self._stop_reading()
+
+    def _fail_pending(self, error):
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(error)
+
+    def close(self):
+        if self._ring is not None:
+            self._ring.unlink()
+
+
 class _LocalServer(WebsocketServer):
-    def __init__(self, num_tokens_per_source, input_queue_maxsize, conn):
+    def __init__(self, num_tokens_per_source, input_queue_maxsize,
+                 engine_factory, num_workers, batch_size, batch_timeout,
+                 affinity_key, affinity_capacity, shm_slot_size,
+                 worker_setup, batches_per_worker):
         super().__init__(num_tokens_per_source)
         self._input_queue = asyncio.Queue(input_queue_maxsize)
-        self._conn = conn
-        self._result_ready = asyncio.Event()
+        self._batch_size = max(1, batch_size)
+        batches_per_worker = max(1, batches_per_worker)
+        self._workers = []
+        for index in range(max(1, num_workers)):
+            ring = (None if shm_slot_size is None else
+                    _FrameRing(self._batch_size * batches_per_worker,
+                               shm_slot_size))
+            self._workers.append(_EngineWorker(
+                index, engine_factory, affinity_capacity, ring, worker_setup,
+                self._batch_size, batches_per_worker))
+        # Workers in the order that they last finished a batch, so the first
+        # one has been waiting the longest.
+        self._ready_workers = []
+        self._worker_ready = asyncio.Event()
+        self._batch_timeout = batch_timeout
+        self._affinity_key = affinity_key
 
     async def _send_to_engine(self, from_client, address):
         if self._input_queue.full():
@@ -44,35 +436,136 @@ class _LocalServer(WebsocketServer):
         return True
 
     def launch(self, port, message_max_size):
-        asyncio.get_event_loop().add_reader(
-            self._conn.fileno(), self._result_ready.set)
+        for worker in self._workers:
+            worker.start()
+        self._ready_workers = list(self._workers)
+        logger.info('Started %d engine processes', len(self._workers))
+
         asyncio.ensure_future(self._engine_comm())
         super().launch(port, message_max_size)
 
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+
+    def _key_for(self, from_client):
+        if self._affinity_key is None:
+            return None
+
+        return self._affinity_key(from_client.input_frame)
+
+    async def _acquire_worker(self, key):
+        '''Pick a worker with room for another batch. Workers that handled
+        key recently come first, then those with the fewest batches in
+        flight.'''
+        while True:
+            candidates = [worker for worker in self._ready_workers
+                          if worker.has_room()]
+            if len(candidates) > 0:
+                break
+            self._worker_ready.clear()
+            await self._worker_ready.wait()
+
+        chosen = min(candidates, key=lambda worker: (
+            not worker.has_key(key), worker.get_num_in_flight()))
+        chosen.begin_batch()
+        return chosen
+
+    def _release_worker(self, worker):
+        worker.end_batch()
+        self._ready_workers.remove(worker)
+        self._ready_workers.append(worker)
+        self._worker_ready.set()
+
+    async def _fill_batch(self, batch):
+        '''Add queued frames to batch until it is full or batch_timeout has
+        passed.'''
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self._batch_timeout
+        while len(batch) < self._batch_size:
+            if not self._input_queue.empty():
+                batch.append(self._input_queue.get_nowait())
+                continue
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(
+                    self._input_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
     async def _engine_comm(self):
         await self.wait_for_start()
         while self.is_running():
-            from_client, address = await self._input_queue.get()
-            self._conn.send_bytes(from_client.input_frame.SerializeToString())
-            result_wrapper = gabriel_pb2.ResultWrapper()
+            first = await self._input_queue.get()
+            from_client, _ = first
+            worker = await self._acquire_worker(self._key_for(from_client))
+            batch = await self._fill_batch([first])
+            asyncio.ensure_future(self._run_batch(worker, batch))
+
+    async def _run_batch(self, worker, batch):
+        for from_client, _ in batch:
+            worker.record_key(self._key_for(from_client))
 
-            if not self._conn.poll():
-                await self._result_ready.wait()
+        try:
+            result_wrappers = await worker.process(
+                [from_client for from_client, _ in batch],
+                [address for _, address in batch])
+        except (EOFError, OSError):
+            logger.error('Engine process died. Starting a replacement.')
+            await worker.restart()
+            result_wrappers = None
 
-            result_wrapper.ParseFromString(self._conn.recv_bytes())
+        for i, (from_client, address) in enumerate(batch):
+            if result_wrappers is None:
+                status = gabriel_pb2.ResultWrapper.Status.ENGINE_ERROR
+                result_wrapper = (
+                    cognitive_engine.CognitiveEngine.create_result_wrapper(
+                        status))
+            else:
+                result_wrapper = result_wrappers[i]
             await self.send_result_wrapper(
                 address, from_client.source_name, from_client.frame_id,
                 result_wrapper, return_token=True)
 
-            self._result_ready.clear()
+        self._release_worker(worker)
 
 
-def _run_engine(engine_factory, conn):
+def _run_engine(engine_factory, conn, ring_args, worker_setup, index):
+    if worker_setup is not None:
+        worker_setup(index)
+    ring = None if ring_args is None else _FrameRing(*ring_args)
     engine = engine_factory()
-    logger.info('Cognitive engine started')
+    logger.info('Cognitive engine started in process %d', os.getpid())
+
+    # Engines that keep several batches in flight send results from their
+    # own threads
+    send_lock = threading.Lock()
+
+    def send_results(batch_id, items, frame_ids, result_wrappers):
+        packed = [
+            _pack_result_wrapper(
+                ring, item[0] if isinstance(item, tuple) else None, frame_id,
+                result_wrapper)
+            for item, frame_id, result_wrapper in zip(
+                items, frame_ids, result_wrappers)]
+        with send_lock:
+            conn.send((batch_id, packed))
+
     while True:
-        input_frame = gabriel_pb2.InputFrame()
-        input_frame.ParseFromString(conn.recv_bytes())
+        batch_id, items, client_ids = conn.recv()
+        frame_ids = []
+        input_frames = []
+        for item in items:
+            frame_id, input_frame = _unpack_input_frame(ring, item)
+            frame_ids.append(frame_id)
+            input_frames.append(input_frame)
 
-        result_wrapper = engine.handle(input_frame)
-        conn.send_bytes(result_wrapper.SerializeToString())
+        engine.handle_batch_async(
+            input_frames,
+            functools.partial(send_results, batch_id, items, frame_ids),
+            client_ids)
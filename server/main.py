@@ -3,25 +3,81 @@
 from gabriel_server.local_engine import LocalEngine
 from openrtist.timing_engine import TimingEngine
 from openrtist.openrtist_engine import OpenrtistEngine
+from openrtist.pipelined_engine import PipelinedEngine
+from openrtist.depth_compositor import DEFAULT_DEPTH_WIDTH
+from openrtist.cpu_partition import CpuPartition, available_cores
 import logging
 import cv2
 import argparse
 import importlib
+import os
 
 DEFAULT_PORT = 9099
 DEFAULT_NUM_TOKENS = 2
 INPUT_QUEUE_MAXSIZE = 60
 DEFAULT_STYLE = "the_scream"
+DEFAULT_NUM_WORKERS = 1
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_BATCH_TIMEOUT_MS = 5
+# Batches that each worker is sent before the first is finished, with
+# --pipeline. One for each of the decode, inference, and encode stages
+DEFAULT_PIPELINE_BATCHES = 3
+SHM_SLOT_SIZE = 8 * 1024 * 1024
+DEFAULT_RESIDENT_STYLES = 4
+DEFAULT_MODEL_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "openrtist", "openvino"
+)
+# Seconds between reports of the CPU use of each core set
+CPU_REPORT_INTERVAL = 30
 COMPRESSION_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 67]
+TORCH_MODES = ("eager", "script", "compile")
 
 logging.basicConfig(level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
 
-def create_adapter(openvino, cpu_only, force_torch, use_myriad):
+def create_adapter(
+    openvino,
+    cpu_only,
+    force_torch,
+    use_myriad,
+    resident_styles=DEFAULT_RESIDENT_STYLES,
+    streams=None,
+    model_cache_mb=None,
+    model_cache_dir=None,
+    reshape_buckets=None,
+    force_onnx=False,
+    onnx_threads=None,
+    torch_mode="eager",
+    bf16=False,
+    int8=False,
+    uint8_io=False,
+    style_bank=False,
+    stages=None,
+    stage_threads=None,
+    cpu_threads=None,
+):
     """Create the best adapter based on constraints passed as CLI arguments."""
 
+    torch_args = dict(
+        max_resident=resident_styles,
+        mode=torch_mode,
+        bf16=bf16,
+        warmup_sizes=reshape_buckets,
+        int8=int8,
+        uint8_io=uint8_io,
+        style_bank=style_bank,
+        stages=stages,
+        stage_threads=stage_threads,
+        pin_stages=cpu_threads is not None,
+        num_threads=cpu_threads,
+    )
+
+    if style_bank or stages:
+        # Only Torch runs the style bank and pipeline stages
+        force_torch = True
+
     if use_myriad:
         openvino = True
         if cpu_only:
@@ -30,6 +86,19 @@ def create_adapter(openvino, cpu_only, force_torch, use_myriad):
     if force_torch and openvino:
         raise Exception("Cannot run with both Torch and OpenVINO")
 
+    if force_onnx:
+        if force_torch or openvino:
+            raise Exception("Cannot run ONNX Runtime with Torch or OpenVINO")
+
+        logger.info("Using ONNX Runtime with CPU")
+        from openrtist.onnx_adapter import OnnxAdapter
+
+        if onnx_threads is None:
+            onnx_threads = cpu_threads
+        return OnnxAdapter(
+            DEFAULT_STYLE, max_resident=resident_styles, intra_threads=onnx_threads
+        )
+
     if not openvino:
         if importlib.util.find_spec("torch") is None:
             logger.info("Could not find Torch")
@@ -41,7 +110,7 @@ def create_adapter(openvino, cpu_only, force_torch, use_myriad):
                 logger.info("Detected GPU / CUDA support")
                 from openrtist.torch_adapter import TorchAdapter
 
-                return TorchAdapter(False, DEFAULT_STYLE)
+                return TorchAdapter(False, DEFAULT_STYLE, **torch_args)
             else:
                 logger.info("Failed to detect GPU / CUDA support")
 
@@ -52,12 +121,15 @@ def create_adapter(openvino, cpu_only, force_torch, use_myriad):
                 raise Exception("No suitable engine")
         else:
             if not cpu_only and not use_myriad:
-                from openvino.inference_engine import IEPlugin
-
                 try:
-                    IEPlugin("GPU")
+                    from openvino import Core
+                except ImportError:
+                    from openvino.runtime import Core
+
+                devices = Core().available_devices
+                if any(device.startswith("GPU") for device in devices):
                     logger.info("Detected iGPU / clDNN support")
-                except RuntimeError:
+                else:
                     logger.info("Failed to detect iGPU / clDNN support")
                     cpu_only = True
 
@@ -66,13 +138,42 @@ def create_adapter(openvino, cpu_only, force_torch, use_myriad):
             logger.info("Use Myriad: %s", use_myriad)
             from openrtist.openvino_adapter import OpenvinoAdapter
 
-            adapter = OpenvinoAdapter(cpu_only, DEFAULT_STYLE, use_myriad=use_myriad)
-            return adapter
+            cache_bytes = None
+            if model_cache_mb is not None:
+                cache_bytes = model_cache_mb * 1024 * 1024
+            try:
+                return OpenvinoAdapter(
+                    cpu_only,
+                    DEFAULT_STYLE,
+                    use_myriad=use_myriad,
+                    max_lru=resident_styles,
+                    num_streams=streams,
+                    cache_bytes=cache_bytes,
+                    cache_dir=model_cache_dir,
+                    buckets=reshape_buckets,
+                    int8=int8,
+                    uint8_io=uint8_io,
+                    num_threads=cpu_threads,
+                )
+            except Exception:
+                # Such as IRs that are older than this OpenVINO release reads
+                if openvino or importlib.util.find_spec("torch") is None:
+                    raise
+                logger.exception("Could not load OpenVINO models")
 
     logger.info("Using Torch with CPU")
     from openrtist.torch_adapter import TorchAdapter
 
-    return TorchAdapter(True, DEFAULT_STYLE)
+    return TorchAdapter(True, DEFAULT_STYLE, **torch_args)
+
+
+def parse_size(value):
+    """Parse a WIDTHxHEIGHT size."""
+    try:
+        width, height = (int(n) for n in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, got " + value)
+    return width, height
 
 
 def main():
@@ -106,20 +207,253 @@ def main():
         action="store_true",
         help="Set this flag to use Myriad VPU (implies use OpenVino).",
     )
+    parser.add_argument(
+        "--torch-mode",
+        choices=TORCH_MODES,
+        default="eager",
+        help="Run Torch networks as defined, frozen with TorchScript, or "
+        "compiled with torch.compile (Torch 2.0 or later). Compiled styles "
+        "are warmed up in the background. A style that is not warmed up, or "
+        "was unloaded, stalls its first frame while it compiles",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Run Torch networks in bfloat16 on CPUs that support it, for styles "
+        "that stay close to float32",
+    )
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="Run INT8 models for styles that have one: from "
+        "scripts/freeze_model.py quantize_static with Torch on the CPU, or from "
+        "model-app/openvino_quantize.py with OpenVINO",
+    )
+    parser.add_argument(
+        "--uint8-io",
+        action="store_true",
+        help="Have OpenVINO and Torch models take decoded frames and return "
+        "images to encode as they are, converting pixel formats in the model",
+    )
+    parser.add_argument(
+        "--style-bank",
+        action="store_true",
+        help="Serve every style with the single Torch network in "
+        "models/style_bank.pt, from model-app/train_style.py --teachers, and "
+        "batch frames for different styles together",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        metavar="BLOCK",
+        help="Split Torch networks into stages that run in separate processes "
+        "on the CPU, starting a new stage at each of these blocks: conv2, "
+        "conv3, res1 to res5, or deconv1 to deconv3",
+    )
+    parser.add_argument(
+        "--stage-threads",
+        type=int,
+        help="Torch threads for each process of --stages. By default the cores "
+        "are shared equally between them",
+    )
+    parser.add_argument(
+        "--onnx",
+        action="store_true",
+        help="Set this flag to use ONNX Runtime on the CPU, with models exported "
+        "by scripts/freeze_model.py export_onnx",
+    )
+    parser.add_argument(
+        "--onnx-threads",
+        type=int,
+        help="Threads that ONNX Runtime uses for each operator. By default it "
+        "uses every core",
+    )
     parser.add_argument(
         "--timing", action="store_true", help="Print timing information"
     )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Decode, run inference, and encode frames on separate threads. Each "
+        "worker is sent --pipeline-batches batches at once, so the stages work "
+        "on different frames. A client only has as many frames in flight as it "
+        "has tokens",
+    )
+    parser.add_argument(
+        "--pipeline-batches",
+        type=int,
+        default=DEFAULT_PIPELINE_BATCHES,
+        help="Batches that each worker is sent before the first is finished, "
+        "with --pipeline",
+    )
     parser.add_argument(
         "-p", "--port", type=int, default=DEFAULT_PORT, help="Set port number"
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DEFAULT_NUM_WORKERS,
+        help="Number of engine processes. Clients get --tokens per process",
+    )
+    parser.add_argument(
+        "--pin-cores",
+        action="store_true",
+        help="Split the cores between the engine processes along NUMA nodes, "
+        "pin each process to its own set, and size the thread pools of OpenCV "
+        "and the inference backend to match. Pipeline stages get a share of "
+        "their process's cores. CPU use per core set is logged",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Maximum number of queued frames to run through the engine together",
+    )
+    parser.add_argument(
+        "--batch-timeout",
+        type=float,
+        default=DEFAULT_BATCH_TIMEOUT_MS,
+        help="Milliseconds to wait for a batch to fill up",
+    )
+    parser.add_argument(
+        "--shared-memory",
+        action="store_true",
+        help="Pass frames to engine processes through shared memory",
+    )
+    parser.add_argument(
+        "--encode-threads",
+        type=int,
+        default=0,
+        help="Threads for encoding the results of a batch in parallel",
+    )
+    parser.add_argument(
+        "--resident-styles",
+        type=int,
+        default=DEFAULT_RESIDENT_STYLES,
+        help="Number of styles each engine process keeps loaded",
+    )
+    parser.add_argument(
+        "--reuse-threshold",
+        type=float,
+        default=0,
+        help="Reuse a client's last result when its new frame differs from the "
+        "stylized one by at most this mean pixel difference (0 disables)",
+    )
+    parser.add_argument(
+        "--inference-scale",
+        type=float,
+        default=1.0,
+        help="Run the network at this fraction of the frame size, from 0.25 to "
+        "1, and upsample results using the frame as a guide. Clients can "
+        "choose their own with the inference_scale field of Extras. Only for "
+        "models that take any input size",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=0,
+        help="Run frames larger than this many pixels on a side as overlapping "
+        "tiles of this size, blended together (0 disables). Only for models "
+        "that take any input size",
+    )
+    parser.add_argument(
+        "--tile-threads",
+        type=int,
+        default=0,
+        help="Threads for running the tiles of a frame in parallel",
+    )
+    parser.add_argument(
+        "--streams",
+        type=int,
+        help="Number of OpenVINO throughput streams. By default the device picks "
+        "a number for the best throughput",
+    )
+    parser.add_argument(
+        "--model-cache-mb",
+        type=int,
+        help="Memory budget for compiled OpenVINO models, in MB. Models are also "
+        "limited to --resident-styles",
+    )
+    parser.add_argument(
+        "--model-cache-dir",
+        default=DEFAULT_MODEL_CACHE_DIR,
+        help="Directory for saving compiled OpenVINO models between runs. "
+        "Pass an empty string to disable",
+    )
+    parser.add_argument(
+        "--reshape-buckets",
+        type=parse_size,
+        nargs="+",
+        metavar="WIDTHxHEIGHT",
+        help="Run OpenVINO models near each client's resolution instead of "
+        "resizing frames to the model size. Frames are padded, or scaled down, "
+        "to one of these sizes, and each style is compiled once per size. "
+        "Torch warms up at these sizes",
+    )
+    parser.add_argument(
+        "--depth-width",
+        type=int,
+        default=DEFAULT_DEPTH_WIDTH,
+        help="Width of the depth maps that clients send",
+    )
     args = parser.parse_args()
+    if args.pipeline and args.timing:
+        logger.warning(
+            "--timing is ignored with --pipeline, which logs the occupancy of "
+            "each stage instead"
+        )
+
+    engine_args = dict(
+        encode_threads=args.encode_threads,
+        reuse_threshold=args.reuse_threshold,
+        depth_width=args.depth_width,
+        inference_scale=args.inference_scale,
+        tile_size=args.tile_size,
+        tile_threads=args.tile_threads,
+    )
+
+    cpu_partition = None
+    if args.pin_cores:
+        cpu_partition = CpuPartition(args.workers)
+        logger.info("Core sets: %s", cpu_partition.describe())
+        cpu_partition.start_reporting(CPU_REPORT_INTERVAL)
 
     def engine_setup():
-        adapter = create_adapter(args.openvino, args.cpu_only, args.torch, args.myriad)
-        if args.timing:
-            engine = TimingEngine(COMPRESSION_PARAMS, adapter)
+        # Engine processes are pinned to their core set by now
+        cpu_threads = len(available_cores()) if args.pin_cores else None
+        adapter = create_adapter(
+            args.openvino,
+            args.cpu_only,
+            args.torch,
+            args.myriad,
+            resident_styles=args.resident_styles,
+            streams=args.streams,
+            model_cache_mb=args.model_cache_mb,
+            model_cache_dir=args.model_cache_dir,
+            reshape_buckets=args.reshape_buckets,
+            force_onnx=args.onnx,
+            onnx_threads=args.onnx_threads,
+            torch_mode=args.torch_mode,
+            bf16=args.bf16,
+            int8=args.int8,
+            uint8_io=args.uint8_io,
+            style_bank=args.style_bank,
+            stages=args.stages,
+            stage_threads=args.stage_threads,
+            cpu_threads=cpu_threads,
+        )
+        if args.pipeline:
+            engine = PipelinedEngine(
+                COMPRESSION_PARAMS,
+                adapter,
+                max_batch_size=args.batch_size,
+                **engine_args
+            )
+        elif args.timing:
+            engine = TimingEngine(COMPRESSION_PARAMS, adapter, **engine_args)
         else:
-            engine = OpenrtistEngine(COMPRESSION_PARAMS, adapter)
+            engine = OpenrtistEngine(COMPRESSION_PARAMS, adapter, **engine_args)
 
         return engine
 
@@ -129,6 +463,14 @@ def main():
         INPUT_QUEUE_MAXSIZE,
         args.port,
         args.tokens,
+        batch_size=args.batch_size,
+        batch_timeout=args.batch_timeout / 1000,
+        num_workers=args.workers,
+        affinity_key=OpenrtistEngine.requested_style,
+        affinity_capacity=args.resident_styles,
+        shm_slot_size=SHM_SLOT_SIZE if args.shared_memory else None,
+        worker_setup=None if cpu_partition is None else cpu_partition.pin,
+        batches_per_worker=args.pipeline_batches if args.pipeline else 1,
     )
 
 
@@ -0,0 +1,57 @@
+import threading
+import weakref
+from collections import OrderedDict
+
+# Free buffers kept for each shape
+MAX_FREE = 8
+# Distinct shapes with free buffers, least recently used first
+MAX_SHAPES = 8
+
+
+class BufferPool:
+    """Reuses the buffers that adapters fill with preprocessed frames.
+
+    acquire(shape) returns a free buffer of that shape, or one made by
+    allocate(shape) if there is none. Adapters release a buffer once
+    inference no longer reads it, so a steady stream of frames cycles
+    through the same few buffers instead of allocating new ones. Buffers
+    that were not acquired from the pool are ignored by release, so callers
+    can release whatever preprocessing returned."""
+
+    def __init__(self, allocate):
+        self._allocate = allocate
+        # Shape -> free buffers
+        self._free = OrderedDict()
+        # id -> buffer, for buffers that have been acquired and not released.
+        # Comparing the buffer itself tells it apart from a later object that
+        # got the same id. Entries go away with their buffers, so buffers that
+        # are never released are not kept alive.
+        self._lent = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def acquire(self, shape):
+        shape = tuple(shape)
+        with self._lock:
+            free = self._free.get(shape)
+            buffer = free.pop() if free else None
+            if buffer is None:
+                buffer = self._allocate(shape)
+            self._lent[id(buffer)] = buffer
+            return buffer
+
+    def release(self, buffer):
+        shape = tuple(buffer.shape)
+        with self._lock:
+            if self._lent.get(id(buffer)) is not buffer:
+                return
+            del self._lent[id(buffer)]
+
+            free = self._free.get(shape)
+            if free is None:
+                if len(self._free) >= MAX_SHAPES:
+                    self._free.popitem(last=False)
+                free = self._free[shape] = []
+            else:
+                self._free.move_to_end(shape)
+            if len(free) < MAX_FREE:
+                free.append(buffer)
@@ -0,0 +1,158 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def rss_bytes():
+    """Resident set size of this process, or None if it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class CompiledModelCache:
+    """Compiled models, least recently used first.
+
+    Keys identify what was compiled, such as (style, input size, device).
+    Each entry is charged the growth in resident memory that loading it
+    caused. Least recently used entries are evicted while the total is over
+    budget_bytes or there are more than max_entries, but the newest entry is
+    always kept."""
+
+    def __init__(self, budget_bytes=None, max_entries=None):
+        self.budget_bytes = budget_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+        self.total_bytes = 0
+
+        # key -> (value, size in bytes, unload function)
+        self._entries = OrderedDict()
+        # key -> lock held while that key loads
+        self._loading = {}
+        self._lock = threading.Lock()
+
+        if budget_bytes is not None and rss_bytes() is None:
+            logger.warning("Cannot measure memory use. Ignoring model cache budget")
+
+    def get(self, key, load, unload=None):
+        """Return the value for key, calling load() to create it on a miss.
+
+        unload(value) is called when an entry is evicted. Entries for other
+        keys can be used while one is loading."""
+        with self._lock:
+            value = self._hit(key)
+            if value is not None:
+                return value
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            with self._lock:
+                value = self._hit(key)
+                if value is not None:
+                    return value
+                self.misses += 1
+
+            start = time.time()
+            rss_before = rss_bytes()
+            try:
+                value = load()
+            except Exception:
+                with self._lock:
+                    self._loading.pop(key, None)
+                raise
+            rss_after = rss_bytes()
+            elapsed = time.time() - start
+
+            # Approximate when other keys load at the same time
+            size = 0
+            if rss_before is not None and rss_after is not None:
+                size = max(rss_after - rss_before, 0)
+
+            with self._lock:
+                self._loading.pop(key, None)
+                self._entries[key] = (value, size, unload)
+                self.total_bytes += size
+                self.load_time += elapsed
+                logger.info(
+                    "Loaded %s in %.0f ms (%.1f MB). %d cached, %.1f MB",
+                    key,
+                    elapsed * 1000,
+                    size / MB,
+                    len(self._entries),
+                    self.total_bytes / MB,
+                )
+
+                evicted = self._pop_over_limit()
+
+            # Unloading can wait for a model's requests to finish, so it must
+            # not hold up lookups of other keys
+            for evicted_value, evicted_unload in evicted:
+                if evicted_unload is not None:
+                    evicted_unload(evicted_value)
+            return value
+
+    def _hit(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def discard(self, key):
+        """Drop the entry for key without unloading it, such as when it no
+        longer works. The next get loads it again."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+    def has_room(self):
+        """Whether another entry can be added without evicting one."""
+        with self._lock:
+            if self.max_entries is not None and len(self._entries) >= self.max_entries:
+                return False
+            return self.budget_bytes is None or self.total_bytes < self.budget_bytes
+
+    def _over_limit(self):
+        if len(self._entries) <= 1:
+            return False
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        return self.budget_bytes is not None and self.total_bytes > self.budget_bytes
+
+    def _pop_over_limit(self):
+        """Remove least recently used entries while over the limits. Returns
+        (value, unload function) for each of them, to unload once the lock is
+        released."""
+        evicted = []
+        while self._over_limit():
+            key, (value, size, unload) = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            logger.info("Evicted %s (%.1f MB)", key, size / MB)
+            evicted.append((value, unload))
+        return evicted
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "load_time": self.load_time,
+            }
@@ -0,0 +1,223 @@
+import cv2
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SYS_CPU = "/sys/devices/system/cpu"
+SYS_NODE = "/sys/devices/system/node"
+# OpenMP, MKL, and OpenBLAS size their thread pools from these when they are
+# loaded
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+
+class CpuPartition:
+    """Splits the cores that this process may run on into num_parts sets,
+    one for each engine process, so that co-located engines do not compete
+    for cores.
+
+    Sets follow the topology of the machine: they only span NUMA nodes when
+    they need more cores than one node has, and hyperthreads of a physical
+    core go to the same set. Each engine process calls pin with its index,
+    before it starts any threads."""
+
+    def __init__(self, num_parts, cores=None):
+        if cores is None:
+            cores = available_cores()
+        self.core_sets = split_cores(cores, num_parts)
+        self._last_times = _cpu_times()
+        self._lock = threading.Lock()
+
+    def pin(self, index):
+        """Pin this process to core set index. Returns its number of cores."""
+        return pin(self.core_sets[index])
+
+    def describe(self):
+        return ", ".join(
+            "{}: cpus {}".format(index, format_cores(cores))
+            for index, cores in enumerate(self.core_sets)
+        )
+
+    def get_utilization(self):
+        """Fraction of time that the cores of each set were busy since the
+        previous call, from /proc/stat. None where that is not available."""
+        times = _cpu_times()
+        with self._lock:
+            last, self._last_times = self._last_times, times
+        if times is None or last is None:
+            return None
+
+        utilization = []
+        for cores in self.core_sets:
+            busy = total = 0
+            for cpu in cores:
+                if cpu in times and cpu in last:
+                    busy += times[cpu][0] - last[cpu][0]
+                    total += times[cpu][1] - last[cpu][1]
+            utilization.append(busy / total if total else 0.0)
+        return utilization
+
+    def start_reporting(self, interval):
+        """Log the utilization of each core set every interval seconds."""
+
+        def report():
+            while True:
+                time.sleep(interval)
+                utilization = self.get_utilization()
+                if utilization is None:
+                    return
+                logger.info(
+                    "CPU use per core set: %s",
+                    ", ".join(
+                        "cpus {} {:.0f}%".format(format_cores(cores), 100 * value)
+                        for cores, value in zip(self.core_sets, utilization)
+                    ),
+                )
+
+        threading.Thread(target=report, name="cpu-report", daemon=True).start()
+
+
+def available_cores():
+    """Cores that this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores, num_parts):
+    """Split cores into num_parts lists of nearly equal size. Each list gets
+    whole physical cores, with all of their hyperthreads, from a single NUMA
+    node if one still has room for it, and otherwise from as few nodes as
+    possible. With fewer physical cores than parts, hyperthreads of a core
+    can go to different parts, and with fewer cores than parts, parts share
+    cores."""
+    cores = sorted(cores)
+    if len(cores) < num_parts:
+        logger.warning("%d core sets share %d cores", num_parts, len(cores))
+        return [[cores[i % len(cores)]] for i in range(num_parts)]
+
+    nodes = _numa_nodes()
+    # (node, package, core) -> hyperthreads of that physical core
+    siblings = {}
+    for cpu in cores:
+        package, core = _physical_core(cpu)
+        siblings.setdefault((nodes.get(cpu, 0), package, core), []).append(cpu)
+    physical = [siblings[key] for key in sorted(siblings)]
+
+    if len(physical) < num_parts:
+        logger.warning("%d core sets split the hyperthreads of cores", num_parts)
+        ordered = [cpu for threads in physical for cpu in threads]
+        bounds = [len(ordered) * i // num_parts for i in range(num_parts + 1)]
+        return [sorted(ordered[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+    # Node -> physical cores on it that no part has yet
+    free = {}
+    for key in sorted(siblings):
+        free.setdefault(key[0], []).append(siblings[key])
+
+    parts = []
+    for i in range(num_parts):
+        size = len(physical) // num_parts + (i < len(physical) % num_parts)
+        fits = [node for node in free if len(free[node]) >= size]
+        if fits:
+            # The node with the least room that fits, keeping the others free
+            # for sets that need more
+            order = [min(fits, key=lambda node: len(free[node]))]
+        else:
+            order = sorted(free, key=lambda node: -len(free[node]))
+
+        part = []
+        taken = 0
+        for node in order:
+            while taken < size and free[node]:
+                part.extend(free[node].pop(0))
+                taken += 1
+        parts.append(sorted(part))
+    return parts
+
+
+def pin(cores):
+    """Run this process on cores, and size the thread pool of OpenCV, and of
+    OpenMP libraries that are loaded later, to match. Threads that are
+    already running keep their affinity. Returns the number of cores."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    else:
+        logger.warning("Cannot set CPU affinity here")
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(len(cores))
+    cv2.setNumThreads(len(cores))
+    logger.info("Process %d pinned to cpus %s", os.getpid(), format_cores(cores))
+    return len(cores)
+
+
+def format_cores(cores):
+    """cores as ranges, such as 0-3,8."""
+    ranges = []
+    for cpu in sorted(cores):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(start) if start == end else "{}-{}".format(start, end)
+        for start, end in ranges
+    )
+
+
+def _parse_cores(text):
+    cores = []
+    for part in text.strip().split(","):
+        if part:
+            start, _, end = part.partition("-")
+            cores.extend(range(int(start), int(end or start) + 1))
+    return cores
+
+
+def _numa_nodes():
+    """NUMA node of each core, or an empty dict if the kernel does not say."""
+    nodes = {}
+    if not os.path.isdir(SYS_NODE):
+        return nodes
+    for name in os.listdir(SYS_NODE):
+        if name.startswith("node") and name[4:].isdigit():
+            with open(os.path.join(SYS_NODE, name, "cpulist")) as f:
+                for cpu in _parse_cores(f.read()):
+                    nodes[cpu] = int(name[4:])
+    return nodes
+
+
+def _physical_core(cpu):
+    """(package, core) that cpu is a hyperthread of."""
+    topology = os.path.join(SYS_CPU, "cpu{}".format(cpu), "topology")
+    try:
+        with open(os.path.join(topology, "physical_package_id")) as f:
+            package = int(f.read())
+        with open(os.path.join(topology, "core_id")) as f:
+            core = int(f.read())
+    except (OSError, ValueError):
+        return cpu, 0
+    return package, core
+
+
+def _cpu_times():
+    """(busy, total) clock ticks of each core, or None without /proc/stat."""
+    try:
+        with open("/proc/stat") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+
+    times = {}
+    for line in lines:
+        fields = line.split()
+        if not fields[0].startswith("cpu") or fields[0] == "cpu":
+            continue
+        # user, nice, system, idle, iowait, irq, softirq, steal. Guest time
+        # is already counted in user
+        ticks = [int(value) for value in fields[1:9]]
+        total = sum(ticks)
+        times[int(fields[0][3:])] = total - ticks[3] - ticks[4], total
+    return times
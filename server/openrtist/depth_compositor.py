@@ -0,0 +1,70 @@
+import cv2
+import math
+import numpy as np
+
+DEFAULT_DEPTH_WIDTH = 160
+
+# Applied at depth resolution, where one pixel covers several image pixels
+KERNEL_SIZE = (3, 3)
+FEATHER_SIGMA = 0.75
+# Depth pixels around the foreground that the feathered edge can reach
+FEATHER_MARGIN = 2
+
+
+class DepthCompositor:
+    """Keeps the original foreground in front of a stylized background, using
+    a depth map to tell them apart.
+
+    The mask is thresholded, cleaned, and feathered at depth resolution. It
+    is then upsampled to an alpha mask, and the images are blended in one
+    pass over the bounding box of the foreground."""
+
+    def __init__(self, depth_width=DEFAULT_DEPTH_WIDTH):
+        self.depth_width = depth_width
+        self._kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, KERNEL_SIZE)
+
+    def foreground_mask(self, depth_map, depth_threshold):
+        """uint8 mask at depth resolution that is 255 for pixels closer than
+        depth_threshold, with soft edges."""
+        np_depth_1d = np.frombuffer(depth_map, dtype=np.uint16)
+        np_depth_2d = np.reshape(np_depth_1d, (-1, self.depth_width))
+
+        mask = cv2.inRange(np_depth_2d, 0, depth_threshold)
+
+        # Remove extraneous regions and fill small holes
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self._kernel)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self._kernel)
+
+        return cv2.GaussianBlur(mask, (0, 0), FEATHER_SIGMA)
+
+    def composite(self, orig_img, image, depth_map, depth_threshold):
+        """Blend the foreground of orig_img over image, which is resized to
+        match orig_img if needed. image is not modified."""
+        orig_h, orig_w = orig_img.shape[:2]
+        if image.shape[:2] != (orig_h, orig_w):
+            image = cv2.resize(image, (orig_w, orig_h), interpolation=cv2.INTER_LINEAR)
+
+        mask = self.foreground_mask(depth_map, depth_threshold)
+        x, y, w, h = cv2.boundingRect(mask)
+        if w == 0 or h == 0:
+            return image
+
+        # Bounding box of the foreground at image resolution
+        mask_h, mask_w = mask.shape
+        scale_x = orig_w / mask_w
+        scale_y = orig_h / mask_h
+        x0 = max(int((x - FEATHER_MARGIN) * scale_x), 0)
+        y0 = max(int((y - FEATHER_MARGIN) * scale_y), 0)
+        x1 = min(int(math.ceil((x + w + FEATHER_MARGIN) * scale_x)), orig_w)
+        y1 = min(int(math.ceil((y + h + FEATHER_MARGIN) * scale_y)), orig_h)
+
+        alpha = cv2.resize(mask, (orig_w, orig_h), interpolation=cv2.INTER_LINEAR)
+        alpha = alpha[y0:y1, x0:x1]
+        alpha = cv2.merge([alpha] * orig_img.shape[2])
+
+        fg = cv2.multiply(orig_img[y0:y1, x0:x1], alpha, scale=1.0 / 255)
+        bg = cv2.multiply(image[y0:y1, x0:x1], cv2.bitwise_not(alpha), scale=1.0 / 255)
+
+        composited = image.copy()
+        composited[y0:y1, x0:x1] = cv2.add(fg, bg)
+        return composited
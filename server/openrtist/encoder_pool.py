@@ -0,0 +1,123 @@
+import cv2
+import numpy as np
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from openrtist.openrtist_pb2 import Extras
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JPEG_QUALITY = 95
+
+# OpenCV >= 4.5.5 can set the JPEG sampling factor
+_SAMPLING_FACTORS = {
+    Extras.SUBSAMPLING_420: "IMWRITE_JPEG_SAMPLING_FACTOR_420",
+    Extras.SUBSAMPLING_422: "IMWRITE_JPEG_SAMPLING_FACTOR_422",
+    Extras.SUBSAMPLING_444: "IMWRITE_JPEG_SAMPLING_FACTOR_444",
+}
+
+
+class EncoderPool:
+    """Encodes result images with the codec, quality, and chroma subsampling
+    that each client asks for in its Extras.
+
+    OpenCV parameters are built once per setting. Conversion buffers are kept
+    per thread and shape, so frames of a steady stream reuse them. With
+    num_threads > 0, map() spreads work over a thread pool."""
+
+    def __init__(self, compression_params, num_threads=0):
+        self._default_params = list(compression_params)
+        settings = dict(zip(compression_params[::2], compression_params[1::2]))
+        self._default_quality = settings.get(
+            cv2.IMWRITE_JPEG_QUALITY, DEFAULT_JPEG_QUALITY
+        )
+        self._params = {}
+        self._local = threading.local()
+        self._warned_subsampling = False
+        self._executor = None
+        if num_threads > 0:
+            self._executor = ThreadPoolExecutor(
+                num_threads, thread_name_prefix="encode"
+            )
+
+    def map(self, fn, items):
+        """Call fn on each item, on the thread pool if there is one."""
+        if self._executor is None:
+            return [fn(item) for item in items]
+        return list(self._executor.map(fn, items))
+
+    def _buffer(self, kind, shape, dtype):
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        key = (kind, shape, dtype)
+        buf = buffers.get(key)
+        if buf is None:
+            buf = buffers[key] = np.empty(shape, dtype)
+        return buf
+
+    def to_uint8(self, image):
+        """Convert image to uint8, in a buffer that is reused by the next call
+        on this thread."""
+        if image.dtype == np.uint8:
+            return image
+        buf = self._buffer("uint8", image.shape, np.uint8)
+        np.copyto(buf, image, casting="unsafe")
+        return buf
+
+    def encode(self, image, extras):
+        """Encode a uint8 image as requested by extras.
+
+        Returns the payload and the codec that was used."""
+        codec = extras.output_codec
+        if codec == Extras.RAW_RGB:
+            # Images are encoded as if they were BGR, so swap channels to give
+            # the pixels that a client would get by decoding a JPEG result.
+            buf = self._buffer("raw", image.shape, np.uint8)
+            cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=buf)
+            return buf.tobytes(), codec
+
+        if codec != Extras.WEBP:
+            codec = Extras.JPEG
+        params = self._params_for(
+            codec, extras.output_quality, extras.output_chroma_subsampling
+        )
+        ext = ".webp" if codec == Extras.WEBP else ".jpg"
+        _, encoded = cv2.imencode(ext, image, params)
+        return encoded.tobytes(), codec
+
+    def _params_for(self, codec, quality, subsampling):
+        key = (codec, quality, subsampling)
+        params = self._params.get(key)
+        if params is not None:
+            return params
+
+        if quality:
+            quality = min(max(quality, 1), 100)
+        if codec == Extras.WEBP:
+            params = [cv2.IMWRITE_WEBP_QUALITY, quality or self._default_quality]
+        else:
+            params = list(self._default_params)
+            if quality:
+                params = _replace_param(params, cv2.IMWRITE_JPEG_QUALITY, quality)
+            if subsampling in _SAMPLING_FACTORS:
+                if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+                    params = _replace_param(
+                        params,
+                        cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                        getattr(cv2, _SAMPLING_FACTORS[subsampling]),
+                    )
+                elif not self._warned_subsampling:
+                    logger.warning(
+                        "This OpenCV cannot set JPEG chroma subsampling. Ignoring"
+                    )
+                    self._warned_subsampling = True
+
+        self._params[key] = params
+        return params
+
+
+def _replace_param(params, flag, value):
+    settings = dict(zip(params[::2], params[1::2]))
+    settings[flag] = value
+    return [item for pair in settings.items() for item in pair]
@@ -0,0 +1,53 @@
+import cv2
+import numpy as np
+
+# Applied at the resolution of the stylized image
+DEFAULT_RADIUS = 4
+# Regularization of the guided filter, for a guide with values from 0 to 1.
+# Larger values smooth more and follow the edges of the guide less.
+DEFAULT_EPS = 1e-3
+
+
+class GuidedUpsampler:
+    """Upsamples a stylized image to the size of the frame it came from,
+    using the full-size frame as a guide so that its edges stay sharp.
+
+    This is the fast guided filter (He and Sun, 2015). Each channel of the
+    stylized image is fit locally as a linear function of the brightness of
+    the frame, at the low resolution. The coefficients of those functions
+    are then upsampled and applied to the full-size brightness."""
+
+    def __init__(self, radius=DEFAULT_RADIUS, eps=DEFAULT_EPS):
+        self.ksize = (2 * radius + 1, 2 * radius + 1)
+        self.eps = eps
+
+    def upsample(self, image, guide, bgr=False):
+        """Upsample image, a uint8 RGB image, to the size of guide, a uint8
+        RGB frame or a BGR one if bgr is set."""
+        guide = cv2.cvtColor(guide, cv2.COLOR_BGR2GRAY if bgr else cv2.COLOR_RGB2GRAY)
+        height, width = guide.shape
+        low_height, low_width = image.shape[:2]
+        guide = np.float32(guide) * (1.0 / 255.0)
+        low_guide = cv2.resize(
+            guide, (low_width, low_height), interpolation=cv2.INTER_AREA
+        )[:, :, np.newaxis]
+        image = np.float32(image)
+
+        mean_guide = self._box(low_guide)
+        mean_image = self._box(image)
+        var_guide = self._box(low_guide * low_guide) - mean_guide * mean_guide
+        cov = self._box(low_guide * image) - mean_guide * mean_image
+        a = cov / (var_guide + self.eps)
+        b = mean_image - a * mean_guide
+
+        a = cv2.resize(self._box(a), (width, height), interpolation=cv2.INTER_LINEAR)
+        b = cv2.resize(self._box(b), (width, height), interpolation=cv2.INTER_LINEAR)
+        output = a * guide[:, :, np.newaxis] + b
+        return np.clip(output, 0, 255, out=output).astype(np.uint8)
+
+    def _box(self, img):
+        output = cv2.boxFilter(img, -1, self.ksize, borderType=cv2.BORDER_REFLECT)
+        if output.ndim < img.ndim:
+            # OpenCV drops the channel axis of single-channel images
+            output = output[:, :, np.newaxis]
+        return output
@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
+
+# Start-of-frame markers. 0xC4, 0xC8, and 0xCC share the range but are not
+# frame headers.
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# libjpeg can scale by these factors while decoding the DCT blocks
+_REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+
+def jpeg_size(data):
+    """Return (width, height) from the header of a JPEG, or None if data does
+    not look like a JPEG."""
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Markers without a length
+            i += 2
+            continue
+        if marker in _SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[i + 5 : i + 9])
+            return width, height
+        (length,) = struct.unpack(">H", data[i + 2 : i + 4])
+        i += 2 + length
+
+    return None
+
+
+def reduction_factor(size, target_size):
+    """Largest DCT scaling factor that keeps an image of size at least as big
+    as target_size."""
+    width, height = size
+    target_width, target_height = target_size
+    for factor in sorted(_REDUCED_FLAGS, reverse=True):
+        if width // factor >= target_width and height // factor >= target_height:
+            return factor
+    return 1
+
+
+class ImageDecoder:
+    """Decodes JPEG frames to RGB or BGR, optionally at a reduced scale.
+
+    Uses libjpeg-turbo through PyTurboJPEG when it is installed, which decodes
+    straight to RGB. Otherwise OpenCV decodes to BGR and the (smaller) result
+    is converted."""
+
+    def __init__(self):
+        self._turbo = None
+        if TurboJPEG is not None:
+            try:
+                self._turbo = TurboJPEG()
+            except (OSError, RuntimeError) as e:
+                logger.warning("Could not load libjpeg-turbo: %s", e)
+
+    def decode(self, data, target_size=None, bgr=False):
+        """Decode data to an RGB image, or a BGR image if bgr is set.
+
+        If target_size (width, height) is given, the image is decoded at the
+        smallest DCT scale that is still at least that big. Returns the image
+        and the (height, width) of the full-size frame."""
+        size = jpeg_size(data)
+        factor = 1
+        if size is not None and target_size is not None:
+            factor = reduction_factor(size, target_size)
+
+        if self._turbo is not None and size is not None:
+            img = self._turbo.decode(
+                data,
+                pixel_format=TJPF_BGR if bgr else TJPF_RGB,
+                scaling_factor=(1, factor),
+            )
+        else:
+            np_data = np.frombuffer(data, dtype=np.uint8)
+            flags = _REDUCED_FLAGS.get(factor, cv2.IMREAD_COLOR)
+            img = cv2.imdecode(np_data, flags)
+            if not bgr:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        if size is None:
+            return img, img.shape[:2]
+        return img, (size[1], size[0])
@@ -0,0 +1,167 @@
+from openrtist.openrtist_adapter import OpenrtistAdapter
+from openrtist.buffer_pool import BufferPool
+from collections import OrderedDict
+import numpy as np
+import onnxruntime as ort
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RESIDENT = 4
+# Distinct (batch size, input shape) pairs with buffers kept for each style
+MAX_BINDINGS = 8
+
+
+class OnnxAdapter(OpenrtistAdapter):
+    """Runs ONNX exports of TransformerNet with ONNX Runtime on the CPU.
+
+    Each style is loaded from models/<style>.onnx, which can be created with
+    scripts/freeze_model.py export_onnx. Up to max_resident sessions are kept
+    loaded. Inputs and outputs are bound to buffers that are allocated once
+    for each batch shape and reused for every frame of that shape, and
+    preprocessed frames are written into buffers from a pool.
+
+    intra_threads is the number of threads for a single operator, where the
+    default lets ONNX Runtime use every core. The network is a chain of
+    operators, so they are run one at a time on inter_threads threads."""
+
+    def __init__(
+        self,
+        default_style,
+        max_resident=DEFAULT_MAX_RESIDENT,
+        intra_threads=None,
+        inter_threads=1,
+    ):
+        super().__init__(default_style)
+        self.max_resident = max(1, max_resident)
+
+        self.options = ort.SessionOptions()
+        self.options.graph_optimization_level = (
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if intra_threads is not None:
+            self.options.intra_op_num_threads = intra_threads
+        self.options.inter_op_num_threads = inter_threads
+
+        # Style name -> _Session, least recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = BufferPool(lambda shape: np.empty(shape, np.float32))
+
+        models_dir = "models"
+        self.path = os.path.join(os.getcwd(), ".", models_dir)
+
+        for name in os.listdir(self.path):
+            if name.endswith(".onnx"):
+                self.add_supported_style(name[: -len(".onnx")])
+
+        if self.get_style() is not None:
+            self._session(self.get_style())
+
+    def preprocessing(self, img, style=None):
+        # Change data layout from HWC to CHW and convert to float
+        preprocessed = self._pool.acquire((1, 3) + img.shape[:2])
+        np.multiply(
+            img.transpose((2, 0, 1)), 1.0 / 255.0, out=preprocessed[0], dtype=np.float32
+        )
+        return preprocessed
+
+    def inference(self, preprocessed, style=None):
+        return self.inference_batch([preprocessed], style)[0]
+
+    def inference_batch(self, preprocessed_batch, style=None):
+        session = self._session(self._resolve_style(style))
+        outputs = session.run(preprocessed_batch)
+        for preprocessed in preprocessed_batch:
+            self._pool.release(preprocessed)
+        return list(outputs)
+
+    def postprocessing(self, post_inference):
+        return post_inference.transpose(1, 2, 0)
+
+    def _session(self, style):
+        with self._lock:
+            session = self._sessions.get(style)
+            if session is not None:
+                self._sessions.move_to_end(style)
+                return session
+
+            if len(self._sessions) >= self.max_resident:
+                old_style, _ = self._sessions.popitem(last=False)
+                logger.debug("Unloading style %s", old_style)
+
+            model = os.path.join(self.path, "{}.onnx".format(style))
+            logger.info("Loading %s", model)
+            session = _Session(
+                ort.InferenceSession(
+                    model, self.options, providers=["CPUExecutionProvider"]
+                )
+            )
+            self._sessions[style] = session
+            return session
+
+
+class _Session:
+    """An inference session with input and output buffers bound for each
+    input shape, least recently used first."""
+
+    def __init__(self, session):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+        self.output_name = session.get_outputs()[0].name
+
+        # Input shape -> (IO binding, input buffer, output buffer)
+        self._bindings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(self, preprocessed_batch):
+        """Run a batch of inputs of the same shape, and return the outputs
+        clipped to pixel values."""
+        shape = (len(preprocessed_batch),) + preprocessed_batch[0].shape[1:]
+        with self._lock:
+            binding, input_buffer, output_buffer = self._binding(shape)
+            np.concatenate(preprocessed_batch, out=input_buffer)
+            self.session.run_with_iobinding(binding)
+            # Copies the output out of the buffer that the next batch reuses
+            return np.clip(output_buffer, 0, 255)
+
+    def _binding(self, shape):
+        entry = self._bindings.get(shape)
+        if entry is not None:
+            self._bindings.move_to_end(shape)
+            return entry
+
+        if len(self._bindings) >= MAX_BINDINGS:
+            self._bindings.popitem(last=False)
+
+        input_buffer = np.zeros(shape, np.float32)
+        # The output size can differ from the input size, so find it once
+        output_shape = self.session.run(
+            [self.output_name], {self.input_name: input_buffer}
+        )[0].shape
+        output_buffer = np.empty(output_shape, np.float32)
+
+        binding = self.session.io_binding()
+        binding.bind_input(
+            self.input_name,
+            "cpu",
+            0,
+            np.float32,
+            input_buffer.shape,
+            input_buffer.ctypes.data,
+        )
+        binding.bind_output(
+            self.output_name,
+            "cpu",
+            0,
+            np.float32,
+            output_buffer.shape,
+            output_buffer.ctypes.data,
+        )
+
+        entry = binding, input_buffer, output_buffer
+        self._bindings[shape] = entry
+        return entry
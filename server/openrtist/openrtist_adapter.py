@@ -7,33 +7,86 @@ logger = logging.getLogger(__name__)
 
 
 class OpenrtistAdapter(ABC):
+    """Runs style transfer models.
+
+    Methods that depend on the style take it as an argument, so frames for
+    different styles can be interleaved. When style is None, the style set
+    with set_style is used."""
+
     def __init__(self, default_style):
         self._style = None
+        self._default_style = default_style
+        # Whether preprocessing takes BGR frames and postprocessing returns
+        # the uint8 image to encode, because the model converts pixel
+        # formats itself. Otherwise frames are RGB and results may be float.
+        self.uint8_io = False
+        # Whether inference_batch and inference_async accept a list with the
+        # style of each image, so one batch can mix styles
+        self.mixed_style_batches = False
         self.path = "."
         self.supported_styles = {}
 
+        # Style images, loaded when the models directory changes
+        self._style_images = {}
+        self._assets_mtime = None
+        self._assets_version = 0
+
     @abstractmethod
-    def preprocessing(self, img):
+    def preprocessing(self, img, style=None):
         """Model-specific preprocessing"""
         pass
 
     @abstractmethod
-    def inference(self, preprocessed):
+    def inference(self, preprocessed, style=None):
         pass
 
+    def inference_batch(self, preprocessed_batch, style=None):
+        """Run inference on preprocessed images of the same shape.
+
+        Adapters that can stack inputs into a single forward pass should
+        override this."""
+        return [
+            self.inference(preprocessed, style) for preprocessed in preprocessed_batch
+        ]
+
+    def inference_async(self, preprocessed_batch, callback, style=None, errback=None):
+        """Start inference on preprocessed images of the same shape, and call
+        callback with the list of results when they are all done. If any of
+        them fails, errback is called with the exception instead. Without
+        errback, failures are raised or logged.
+
+        callback and errback may run on another thread. Adapters that can
+        keep several frames in flight should override this. By default the
+        work is done before this returns."""
+        try:
+            outputs = self.inference_batch(preprocessed_batch, style)
+        except Exception as e:
+            if errback is None:
+                raise
+            errback(e)
+            return
+        callback(outputs)
+
     @abstractmethod
     def postprocessing(self, post_inference):
         """Model-specific postprocessing"""
         pass
 
-    def add_supported_style(self, new_style):
+    def get_input_size(self, style=None):
+        """(width, height) that preprocessing resizes images to, or None if
+        the model takes images of any size."""
+        return None
+
+    def _read_description(self, style):
         try:
-            with open(os.path.join(self.path, "{}.txt".format(new_style)), "r") as f:
-                info_text = f.read()
+            with open(os.path.join(self.path, "{}.txt".format(style)), "r") as f:
+                return f.read()
         except IOError:
-            info_text = new_style + " -- Unknown"
-        self.supported_styles[new_style] = info_text
-        if self._style is None:
+            return style + " -- Unknown"
+
+    def add_supported_style(self, new_style):
+        self.supported_styles[new_style] = self._read_description(new_style)
+        if self._style is None or new_style == self._default_style:
             self.set_style(new_style)
 
     def set_style(self, new_style):
@@ -46,15 +99,49 @@ class OpenrtistAdapter(ABC):
     def get_style(self):
         return self._style
 
-    def _style_image(self):
-        return os.path.join(self.path, "{}.jpg".format(self._style))
+    def _resolve_style(self, style):
+        return self._style if style is None else style
 
-    def get_style_image(self):
+    def _style_image(self, style):
+        return os.path.join(self.path, "{}.jpg".format(style))
+
+    def _read_style_image(self, style):
         try:
-            with open(self._style_image(), "rb") as f:
+            with open(self._style_image(style), "rb") as f:
                 return f.read()
         except IOError:
             return b""
 
+    def _check_assets(self):
+        """Load style images and descriptions if files were added, removed, or
+        replaced in the models directory since they were last loaded."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._assets_mtime:
+            return
+
+        if self._assets_mtime is not None:
+            logger.info("Models directory changed. Reloading style assets")
+            for style in self.supported_styles:
+                self.supported_styles[style] = self._read_description(style)
+        self._style_images = {
+            style: self._read_style_image(style) for style in self.supported_styles
+        }
+        self._assets_mtime = mtime
+        self._assets_version += 1
+
+    def get_assets_version(self):
+        """Number that changes whenever style images or descriptions are
+        reloaded, for callers that cache data derived from them."""
+        self._check_assets()
+        return self._assets_version
+
+    def get_style_image(self, style=None):
+        self._check_assets()
+        return self._style_images.get(self._resolve_style(style), b"")
+
     def get_all_styles(self):
+        self._check_assets()
         return self.supported_styles
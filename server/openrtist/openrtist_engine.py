@@ -31,12 +31,13 @@
 # https://github.com/pytorch/examples/blob/master/LICENSE
 
 import cv2
-import numpy as np
 import logging
 from gabriel_server.cognitive_engine import CognitiveEngine,Engine
 from gabriel_protocol import gabriel_pb2
 import openrtist.openrtist_pb2
 import os
+from collections import namedtuple
+from collections import OrderedDict
 from io import BytesIO
 
 logger = logging.getLogger(__name__)
@@ -47,19 +48,77 @@ from msrest.authentication import CognitiveServicesCredentials
 import http.client, urllib.request, urllib.parse, urllib.error, base64
 import json
 from openrtist.emotion_to_style import emotion_to_style_map
+from openrtist.image_decoder import ImageDecoder
+from openrtist.encoder_pool import EncoderPool
+from openrtist.temporal_cache import TemporalCache
+from openrtist.depth_compositor import DepthCompositor, DEFAULT_DEPTH_WIDTH
+from openrtist.guided_upsampler import GuidedUpsampler
+from openrtist.tiler import Tiler
+
+# Smallest fraction of the frame size that clients can run the network at
+MIN_INFERENCE_SCALE = 0.25
+# Clients whose last style is remembered, so they are only sent the style
+# image when their style changes
+MAX_CLIENTS = 64
+
+
+_Frame = namedtuple(
+    "_Frame",
+    [
+        "extras",
+        "style",
+        "new_style",
+        "send_style_list",
+        "orig_img",
+        # Image that the network runs on: orig_img, or a downscaled copy
+        "input_img",
+        "orig_size",
+        "client_id",
+        "thumbnail",
+    ],
+)
 
 
 class OpenrtistEngine(Engine):
     SOURCE_NAME = "openrtist"
 
-    def __init__(self, compression_params, adapter):
+    def __init__(
+        self,
+        compression_params,
+        adapter,
+        encode_threads=0,
+        reuse_threshold=0,
+        depth_width=DEFAULT_DEPTH_WIDTH,
+        inference_scale=1.0,
+        tile_size=0,
+        tile_threads=0,
+    ):
         self.compression_params = compression_params
         self.adapter = adapter
+        self.decoder = ImageDecoder()
+        self.encoder = EncoderPool(compression_params, encode_threads)
+        self.depth_compositor = DepthCompositor(depth_width)
+        self.inference_scale = inference_scale
+        self.upsampler = GuidedUpsampler()
+        self.tiler = None
+        if tile_size > 0:
+            self.tiler = Tiler(tile_size, num_threads=tile_threads)
+        # client_id -> style of its last frame, used to tell each client when
+        # its style changes. Least recently seen first.
+        self._last_styles = OrderedDict()
+        self.temporal_cache = None
+        if reuse_threshold > 0:
+            self.temporal_cache = TemporalCache(reuse_threshold)
+        # Serialized Extras with style images and the style list, which
+        # are merged into results by appending them to the packed Extras
+        self._fragments = {}
+        self._fragments_version = None
         self.face_supported = os.getenv("FaceEnabled", False)
         if self.face_supported:
             logger.info("Emotion-based styling enabled via MS Face Service.")
         else:
             logger.info("Emotion-based styling disabled.")
+        self._style_list_fragment()
         # The waterMark is of dimension 30x120
         #wtr_mrk4 = cv2.imread("../wtrMrk.png", -1)
         # The RGB channels are equivalent
@@ -79,82 +138,184 @@ class OpenrtistEngine(Engine):
 
     def handle(self, input_frame):
         if input_frame.payload_type != gabriel_pb2.PayloadType.IMAGE:
-            status = gabriel_pb2.ResultWrapper.Status.WRONG_INPUT_FORMAT
-            return CognitiveEngine.create_result_wrapper(status)
+            return self._wrong_input_format()
 
+        frame = self._prepare(input_frame)
+
+        # It is possible that no face is detected and style is None, if so bypass processing
+        if frame.style:
+            image = self.process_image(frame.input_img, frame.style)
+        else:
+            image = frame.orig_img
+
+        return self._finish(frame, image)
+
+    def handle_batch(self, input_frames, client_ids=None):
+        """Process several frames, running one inference per group of frames
+        that share a style and an input resolution. If the adapter can mix
+        styles in a batch, frames are only grouped by resolution."""
+        result_wrappers = [None] * len(input_frames)
+        frames = {}
+        groups = OrderedDict()
+        for i, input_frame in enumerate(input_frames):
+            if input_frame.payload_type != gabriel_pb2.PayloadType.IMAGE:
+                result_wrappers[i] = self._wrong_input_format()
+                continue
+
+            client_id = None if client_ids is None else client_ids[i]
+            frame = self._prepare(input_frame, client_id)
+            frames[i] = frame
+            if not frame.style:
+                result_wrappers[i] = self._finish(frame, frame.orig_img)
+                continue
+
+            image = self._reuse(frame)
+            if image is None:
+                key = None if self.adapter.mixed_style_batches else frame.style
+                groups.setdefault((key, frame.input_img.shape), []).append(i)
+            else:
+                result_wrappers[i] = self._finish(frame, image)
+
+        for (style, _), indices in groups.items():
+            if style is None:
+                style = [frames[i].style for i in indices]
+            images = self.process_images([frames[i].input_img for i in indices], style)
+            for i, image in zip(indices, images):
+                self._remember(frames[i], image)
+            finished = self.encoder.map(
+                lambda args: self._finish(*args),
+                [(frames[i], image) for i, image in zip(indices, images)],
+            )
+            for i, result_wrapper in zip(indices, finished):
+                result_wrappers[i] = result_wrapper
+
+        return result_wrappers
+
+    @staticmethod
+    def requested_style(input_frame):
+        """Style that a frame asks for, used to route frames to engine
+        processes that already have it loaded."""
+        extras = CognitiveEngine.unpack_extras(openrtist.openrtist_pb2.Extras, input_frame)
+        return extras.style
+
+    def _wrong_input_format(self):
+        status = gabriel_pb2.ResultWrapper.Status.WRONG_INPUT_FORMAT
+        return CognitiveEngine.create_result_wrapper(status)
+
+    def _prepare(self, input_frame, client_id=None):
+        """Work out which style the frame asks for and decode it."""
         extras = CognitiveEngine.unpack_extras(openrtist.openrtist_pb2.Extras, input_frame)
 
         new_style = False
         send_style_list = False
-        emotion_enabled = False
+        style = self._last_styles.get(client_id, self.adapter.get_style())
 
         if extras.style == "?":
             new_style = True
             send_style_list = True
         elif self.face_supported and extras.style == "aaa_emotion_enabled":
-            emotion_enabled = True
             style = self.emotion_detection(input_frame.payloads[0])
             if style:
-                self.adapter.set_style(style)
                 new_style = True
-        elif extras.style != self.adapter.get_style():
-            self.adapter.set_style(extras.style)
-            logger.info("New Style: %s", extras.style)
+        elif extras.style != style:
+            if extras.style in self.adapter.get_all_styles():
+                logger.info("New Style: %s", extras.style)
+                style = extras.style
+            else:
+                logger.error("Got style %s that we do not have. Ignoring", extras.style)
             new_style = True
 
-        if not emotion_enabled:
-            style = self.adapter.get_style()
-
-        # Preprocessing steps used by both engines
-        np_data = np.frombuffer(input_frame.payloads[0], dtype=np.uint8)
-        orig_img = cv2.imdecode(np_data, cv2.IMREAD_COLOR)
-        orig_img = cv2.cvtColor(orig_img, cv2.COLOR_BGR2RGB)
-
-        # It is possible that no face is detected and style is None, if so bypass processing
+        # Decode at a reduced scale when the adapter would shrink the image
+        # anyway. The depth composite and unstyled frames need the full image.
+        target_size = None
+        scale = 1.0
         if style:
-            image = self.process_image(orig_img)
-        else:
-            image = orig_img
-
-        image = image.astype("uint8")
-        if extras.HasField("depth_map"):
-            # protobuf contains depth_map
-            depth_map = extras.depth_map.value
-            # get depth map (bytes) and perform depth thresholding to create foreground mask with 3 channels
-            depth_threshold = extras.depth_threshold
-
-            # data type conversion from bytes to a scaled-out 2d numpy array (480*640)
-            np_depth_1d = np.frombuffer(depth_map, dtype=np.uint16)
-            np_depth_2d = np.reshape(np_depth_1d, (-1, 160))
-
-            # threshold on the distance
-            mask_fg = cv2.inRange(np_depth_2d, 0, depth_threshold)
-
-            # resize to match the image
-            orig_h, orig_w, _ = orig_img.shape
-            mask_fg = cv2.resize(
-                mask_fg, (orig_w, orig_h), interpolation=cv2.INTER_NEAREST
+            target_size = self.adapter.get_input_size(style)
+            if target_size is None:
+                scale = self._inference_scale(extras)
+            elif extras.HasField("depth_map"):
+                target_size = None
+        # Adapters with uint8_io take frames in the order that OpenCV decodes
+        bgr = bool(style) and self.adapter.uint8_io
+        orig_img, orig_size = self.decoder.decode(
+            input_frame.payloads[0], target_size, bgr
+        )
+
+        # Run the network on a smaller copy. The full-size frame guides the
+        # upsampling of the result.
+        input_img = orig_img
+        if scale < 1:
+            height, width = orig_img.shape[:2]
+            # TransformerNet returns the input size for multiples of 4
+            input_size = (
+                max(4, int(width * scale) // 4 * 4),
+                max(4, int(height * scale) // 4 * 4),
             )
+            input_img = cv2.resize(orig_img, input_size, interpolation=cv2.INTER_AREA)
 
-            # Apply morphology to the thresholded image to remove extraneous white regions and save a mask
-            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-            mask_fg = cv2.morphologyEx(mask_fg, cv2.MORPH_OPEN, kernel)
-            mask_fg = cv2.morphologyEx(mask_fg, cv2.MORPH_CLOSE, kernel)
+        thumbnail = None
+        if self.temporal_cache is not None and style and client_id is not None:
+            thumbnail = self.temporal_cache.thumbnail(orig_img)
 
-            fg = cv2.bitwise_and(orig_img, orig_img, mask=mask_fg)
-
-            # get background mask by inversion
-            mask_bg = cv2.bitwise_not(mask_fg)
+        if style:
+            self._last_styles[client_id] = style
+            self._last_styles.move_to_end(client_id)
+            while len(self._last_styles) > MAX_CLIENTS:
+                self._last_styles.popitem(last=False)
+        return _Frame(
+            extras,
+            style,
+            new_style,
+            send_style_list,
+            orig_img,
+            input_img,
+            orig_size,
+            client_id,
+            thumbnail,
+        )
+
+    def _inference_scale(self, extras):
+        """Fraction of the frame size to run the network at, as the client
+        asked or else the server default."""
+        scale = extras.inference_scale or self.inference_scale
+        return min(max(scale, MIN_INFERENCE_SCALE), 1.0)
+
+    def _reuse(self, frame):
+        """Stylized image from the temporal cache for a frame that is almost
+        the same as its client's previous one, or None."""
+        if frame.thumbnail is None:
+            return None
+        return self.temporal_cache.lookup(
+            frame.client_id, frame.style, frame.orig_img, frame.thumbnail
+        )
+
+    def _remember(self, frame, image):
+        if frame.thumbnail is not None:
+            self.temporal_cache.store(
+                frame.client_id, frame.style, frame.orig_img, frame.thumbnail, image
+            )
 
-            # get background from transformed image
-            bg = cv2.bitwise_and(image, image, mask=mask_bg)
+    def _finish(self, frame, image):
+        """Composite, encode and wrap a stylized image."""
+        extras = frame.extras
+        orig_img = frame.orig_img
+        style = frame.style
 
-            # stitch transformed background and original foreground
-            image = cv2.bitwise_or(fg, bg)
+        image = self.encoder.to_uint8(image)
+        if frame.input_img is not orig_img:
+            image = self.upsampler.upsample(
+                image, orig_img, bgr=bool(style) and self.adapter.uint8_io
+            )
+        if extras.HasField("depth_map"):
+            if style and self.adapter.uint8_io:
+                orig_img = cv2.cvtColor(orig_img, cv2.COLOR_BGR2RGB)
+            image = self.depth_compositor.composite(
+                orig_img, image, extras.depth_map.value, extras.depth_threshold
+            )
 
         # scale image back to original size to get a better watermark
-        if orig_img.shape != image.shape:
-            orig_h, orig_w, _ = orig_img.shape
+        if frame.orig_size != image.shape[:2]:
+            orig_h, orig_w = frame.orig_size
             image = cv2.resize(
                 image, (orig_w, orig_h), interpolation=cv2.INTER_LINEAR
             )
@@ -162,21 +323,57 @@ class OpenrtistEngine(Engine):
         # DISABLED WATERMARK
         #image = self._apply_watermark(image)
 
-        _, jpeg_img = cv2.imencode(".jpg", image, self.compression_params)
-        img_data = jpeg_img.tostring()
+        img_data, codec = self.encoder.encode(image, extras)
 
         result = gabriel_pb2.ResultWrapper.Result()
         result.payload_type = gabriel_pb2.PayloadType.IMAGE
         result.payload = img_data
 
         extras = openrtist.openrtist_pb2.Extras()
+        extras.output_codec = codec
+        if codec == openrtist.openrtist_pb2.Extras.RAW_RGB:
+            extras.output_height, extras.output_width = image.shape[:2]
 
         if style:
             extras.style = style
 
-        if new_style:
-            extras.style_image.value = self.adapter.get_style_image()
-        if send_style_list:
+        status = gabriel_pb2.ResultWrapper.Status.SUCCESS
+        result_wrapper = CognitiveEngine.create_result_wrapper(status)
+        result_wrapper.results.append(result)
+        result_wrapper.extras.Pack(extras)
+
+        # Parsing concatenated messages merges them
+        if frame.new_style:
+            result_wrapper.extras.value += self._style_image_fragment(style)
+        if frame.send_style_list:
+            result_wrapper.extras.value += self._style_list_fragment()
+
+        return result_wrapper
+
+    def _fragment(self, key, fill):
+        """Serialized Extras filled in by fill(extras), cached until the
+        adapter reloads its style assets."""
+        version = self.adapter.get_assets_version()
+        if version != self._fragments_version:
+            self._fragments = {}
+            self._fragments_version = version
+
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            extras = openrtist.openrtist_pb2.Extras()
+            fill(extras)
+            fragment = extras.SerializeToString()
+            self._fragments[key] = fragment
+        return fragment
+
+    def _style_image_fragment(self, style):
+        def fill(extras):
+            extras.style_image.value = self.adapter.get_style_image(style)
+
+        return self._fragment(("style_image", style), fill)
+
+    def _style_list_fragment(self):
+        def fill(extras):
             if self.face_supported:
                 extras.style_list[
                     "aaa_emotion_enabled"
@@ -184,12 +381,7 @@ class OpenrtistEngine(Engine):
             for k, v in self.adapter.get_all_styles().items():
                 extras.style_list[k] = v
 
-        status = gabriel_pb2.ResultWrapper.Status.SUCCESS
-        result_wrapper = CognitiveEngine.create_result_wrapper(status)
-        result_wrapper.results.append(result)
-        result_wrapper.extras.Pack(extras)
-
-        return result_wrapper
+        return self._fragment(("style_list",), fill)
 
     # https://westus.dev.cognitive.microsoft.com/docs/services/563879b61984550e40cbbe8d/operations/563879b61984550f30395236
     def emotion_detection(self, img_bytes):
@@ -222,15 +414,47 @@ class OpenrtistEngine(Engine):
 
         return style
 
-    def process_image(self, image):
-        preprocessed = self.adapter.preprocessing(image)
-        post_inference = self.inference(preprocessed)
+    def process_image(self, image, style=None):
+        if self._tiled(image, style):
+            return self.tiler.run(image, lambda tile: self._process_image(tile, style))
+        return self._process_image(image, style)
+
+    def _process_image(self, image, style):
+        preprocessed = self.adapter.preprocessing(image, style)
+        post_inference = self.inference(preprocessed, style)
         img_out = self.adapter.postprocessing(post_inference)
         return img_out
 
-    def inference(self, preprocessed):
+    def process_images(self, images, style=None):
+        """Stylize several images of the same shape with one inference.
+        style can be a list with the style of each image."""
+        styles = style if isinstance(style, list) else [style] * len(images)
+        if self._tiled(images[0], styles[0]):
+            # Each image runs as its own set of tiles
+            return [self.process_image(image, s) for image, s in zip(images, styles)]
+
+        preprocessed = [
+            self.adapter.preprocessing(image, s) for image, s in zip(images, styles)
+        ]
+        post_inference = self.inference_batch(preprocessed, style)
+        return [self.adapter.postprocessing(p) for p in post_inference]
+
+    def _tiled(self, image, style):
+        """Whether image is split into tiles. Only for models that take any
+        input size."""
+        return (
+            self.tiler is not None
+            and self.tiler.applies(image)
+            and self.adapter.get_input_size(style) is None
+        )
+
+    def inference(self, preprocessed, style=None):
+        """Allow timing engine to override this"""
+        return self.adapter.inference(preprocessed, style)
+
+    def inference_batch(self, preprocessed_batch, style=None):
         """Allow timing engine to override this"""
-        return self.adapter.inference(preprocessed)
+        return self.adapter.inference_batch(preprocessed_batch, style)
 
     def _apply_watermark(self, image):
         img_mrk = image[-30:, -120:]  # The waterMark is of dimension 30x120
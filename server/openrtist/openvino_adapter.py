@@ -29,57 +29,140 @@
 # distributed under the BSD 3-Clause License.
 # https://github.com/pytorch/examples/blob/master/LICENSE
 
-import openvino.inference_engine
-from openvino.inference_engine import IENetwork
-from openvino.inference_engine import IEPlugin
+try:
+    from openvino import AsyncInferQueue, Core, Layout, PartialShape, Type
+    import openvino.opset8 as ops
+except ImportError:
+    # Releases before 2023.1
+    from openvino.runtime import AsyncInferQueue, Core, Layout, PartialShape, Type
+    import openvino.runtime.opset8 as ops
+from openvino.preprocess import ColorFormat, PrePostProcessor
 from openrtist.openrtist_adapter import OpenrtistAdapter
-from cpuinfo import get_cpu_info
+from openrtist.compiled_model_cache import CompiledModelCache
+from openrtist.buffer_pool import BufferPool
 import numpy as np
 import logging
 import os
 import cv2
-from distutils.version import LooseVersion
+import hashlib
+import threading
+import time
+from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
+STATS_INTERVAL = 5
+# Seconds that inference_batch waits for its infer requests. OpenVINO does
+# not call back requests that fail while they run
+INFERENCE_TIMEOUT = 60
+
+# tensor is the network input, and valid is the (height, width) of the part
+# of it that holds the image. The rest is padding
+_Input = namedtuple("_Input", ["tensor", "valid"])
+
 
 class OpenvinoAdapter(OpenrtistAdapter):
-    def __init__(self, cpu_only, default_style, use_myriad=False, max_lru=4):
+    """Runs IR models with the OpenVINO runtime.
+
+    Models are compiled when they are first used, and kept in a cache bounded
+    by max_lru entries and cache_bytes of memory. With cache_dir, compiled
+    models are also saved there and reused by later runs. The default style is
+    loaded first, and with warm, the other styles are loaded in a background
+    thread. Each compiled model has a
+    pool of asynchronous infer requests, so that several frames can be in
+    flight at once. Unless num_streams is given, the device is asked to
+    optimize for throughput, which on CPU sizes the number of streams to the
+    available cores. With num_threads, inference on the CPU uses at most that
+    many threads.
+
+    By default, frames are resized to the input size of the IR. With buckets,
+    a list of (width, height) sizes, frames are instead run near their own
+    resolution. Each frame is padded to the smallest bucket that it fits in,
+    or scaled down to fit the bucket that keeps the most of it, and the
+    network is compiled once per style and bucket.
+
+    With int8, styles that have an INT8 IR (<style>.int8.xml and .bin, from
+    model-app/openvino_quantize.py) run it instead of their original IR.
+
+    With uint8_io, the network takes uint8 BGR frames in NHWC layout and
+    returns the uint8 image to encode in the same layout. The channel swap,
+    scaling, and conversions are added to the network with OpenVINO's
+    preprocessing API, and the first ones are folded into the first
+    convolution when it is compiled.
+
+    Resized and padded frames, and float inputs, are written into buffers
+    from a pool, which are reused once the infer requests that read them are
+    done."""
+
+    def __init__(
+        self,
+        cpu_only,
+        default_style,
+        use_myriad=False,
+        max_lru=4,
+        num_streams=None,
+        cache_bytes=None,
+        cache_dir=None,
+        warm=True,
+        buckets=None,
+        int8=False,
+        uint8_io=False,
+        num_threads=None,
+    ):
         super().__init__(default_style)
-        device = "MYRIAD" if use_myriad else ("CPU" if cpu_only else "GPU")
-        self.plugin = IEPlugin(device=device, plugin_dirs=None)
+        self.uint8_io = uint8_io
+        self.device = "MYRIAD" if use_myriad else ("CPU" if cpu_only else "GPU")
+        self.core = Core()
 
         models_dir = "models"
         model_xml_num = "16"
         model_bin_suff = ".bin"
+        int8_suff = ".int8"
 
         self.path = os.path.join(os.getcwd(), ".", models_dir)
         model_xml = os.path.join(self.path, "{}.xml".format(model_xml_num))
-        self.use_reshape = False  # True  # cpu_only
+        # (height, width) of each bucket, smallest first
+        self.buckets = sorted(((h, w) for w, h in buckets or []), key=_area)
+        self.use_reshape = len(self.buckets) > 0
+        self._buckets_by_size = {}
 
         self.conf = {}
-        if use_myriad:
-            pass
-        elif cpu_only:
-            cpuinf = get_cpu_info()
-            if "avx512" in cpuinf["flags"]:
-                self.plugin.add_cpu_extension("libcpu_extension_avx512.so")
-            elif "avx2" in cpuinf["flags"]:
-                self.plugin.add_cpu_extension("libcpu_extension_avx2.so")
-            else:
-                self.plugin.add_cpu_extension("libcpu_extension_sse4.so")
-            self.conf["CPU_THREADS_NUM"] = str(cpuinf["count"])
-        elif LooseVersion(openvino.inference_engine.__version__) < LooseVersion("2.0"):
-            config_file = os.path.join(
-                os.getcwd(), "..", "clkernels", "mvn_custom_layer.xml"
-            )
-            self.plugin.set_config({"CONFIG_FILE": config_file})
+        if num_streams is not None:
+            self.conf["NUM_STREAMS"] = str(num_streams)
+        elif not use_myriad:
+            self.conf["PERFORMANCE_HINT"] = "THROUGHPUT"
+        if num_threads is not None and self.device == "CPU":
+            self.conf["INFERENCE_NUM_THREADS"] = str(num_threads)
+
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._check_layers = not use_myriad and cpu_only
 
-        self.nets = {}
+        # IR files are read when a style is first compiled
+        self.model_files = {}
+        self._input_sizes = {}
+        self._file_hashes = {}
+        # Only compile one network at a time, which bounds the memory that
+        # compiling takes
+        self._compile_lock = threading.Lock()
+        self.compiled_models = CompiledModelCache(cache_bytes, max_lru)
+
+        self.compiles = 0
+        self.reshapes = 0
+        self.imports = 0
+        self.bucket_frames = {bucket: 0 for bucket in self.buckets}
+        self.padded_frames = 0
+        self.scaled_frames = 0
+        self._stats_lock = threading.Lock()
+        self._lastprint = time.time()
+        # uint8 NHWC frames, and float32 NCHW inputs
+        self._frames = BufferPool(lambda shape: np.empty(shape, np.uint8))
+        self._tensors = BufferPool(lambda shape: np.empty(shape, np.float32))
         names = [
             n[: -len(model_bin_suff)]
             for n in os.listdir(self.path)
-            if n.endswith(model_bin_suff)
+            if n.endswith(model_bin_suff) and not n.endswith(int8_suff + model_bin_suff)
         ]
 
         for name in names:
@@ -88,81 +171,467 @@ class OpenvinoAdapter(OpenrtistAdapter):
             if not os.path.isfile(m_xml):
                 m_xml = model_xml
 
-            # Read IR
-            logger.info("Loading network files:\n\t%s\n\t%s", m_xml, model_bin)
-            net = IENetwork(model=m_xml, weights=model_bin)
+            int8_bin = os.path.join(self.path, name + int8_suff + model_bin_suff)
+            int8_xml = os.path.join(self.path, name + int8_suff + ".xml")
+            if int8 and os.path.isfile(int8_bin) and os.path.isfile(int8_xml):
+                logger.info("Using INT8 model for %s", name)
+                m_xml, model_bin = int8_xml, int8_bin
+
+            self.model_files[name] = (m_xml, model_bin)
+            self.add_supported_style(name)
+
+        default_style = self.get_style()
+        if default_style is not None:
+            sizes = self.buckets if self.use_reshape else [None]
+
+            # Load the default style now, so the first frame does not wait
+            self._compiled(default_style, sizes[0])
 
-            if not use_myriad and cpu_only:
-                supported_layers = self.plugin.get_supported_layers(net)
-                not_supported_layers = [
-                    l for l in net.layers.keys() if l not in supported_layers
+            if warm:
+                keys = [(default_style, size) for size in sizes[1:]]
+                keys += [
+                    (name, size)
+                    for name in names
+                    if name != default_style
+                    for size in sizes
                 ]
+                threading.Thread(
+                    target=self._warm, args=(keys,), name="warm", daemon=True
+                ).start()
 
-                if len(not_supported_layers) != 0:
-                    logger.error(
-                        "Following layers are not supported by the plugin"
-                        " for specified device %s:\n%s",
-                        self.plugin.device,
-                        ", ".join(not_supported_layers),
-                    )
-                    raise Exception()
-
-            self.input_blob = next(iter(net.inputs))
-            self.out_blob = next(iter(net.outputs))
-            net.batch_size = 1
-
-            if self.use_reshape or use_myriad:
-                self.nets[name] = (net, None)
-            else:
-                # Loading model to the plugin
-                logger.info("Loading model to the plugin")
-                self.nets[name] = (net, self.plugin.load(network=net, config=self.conf))
-            self.add_supported_style(name)
-            self.lru_style = []
-            self.max_lru = max_lru
-
-    def preprocessing(self, img):
-        style = self.get_style()
-        net, exec_net = self.nets[style]
-        h, w = net.inputs[self.input_blob].shape[2:]
-        reshaped = False
-        if img.shape[:-1] != (h, w):
-            if self.use_reshape:
-                logger.warning("Network reshaped to %s", str(img.shape[:-1]))
-                net.reshape({self.input_blob: (1, 3, img.shape[0], img.shape[1])})
-                reshaped = True
-            else:
+    def _net(self, style):
+        """Read the IR for style. Parsed models are not kept once they are
+        compiled, so that only compiled models, which the cache bounds, stay
+        in memory."""
+        m_xml, model_bin = self.model_files[style]
+        logger.info("Loading network files:\n\t%s\n\t%s", m_xml, model_bin)
+        net = self.core.read_model(model=m_xml, weights=model_bin)
+
+        if self._check_layers:
+            supported_layers = self.core.query_model(net, self.device)
+            not_supported_layers = [
+                op.get_friendly_name()
+                for op in net.get_ops()
+                if op.get_friendly_name() not in supported_layers
+            ]
+
+            if len(not_supported_layers) != 0:
+                logger.error(
+                    "Following layers are not supported by the plugin"
+                    " for specified device %s:\n%s",
+                    self.device,
+                    ", ".join(not_supported_layers),
+                )
+                raise Exception()
+
+        if self.uint8_io:
+            net = _with_uint8_io(net)
+        return net
+
+    def _blob_path(self, style, size):
+        """File for the compiled model of style at input size, named by a hash
+        of everything that affects compilation."""
+        file_hash = self._file_hashes.get(style)
+        if file_hash is None:
+            file_hash = hashlib.sha256()
+            for name in self.model_files[style]:
+                with open(name, "rb") as f:
+                    file_hash.update(f.read())
+            file_hash = self._file_hashes[style] = file_hash.hexdigest()
+
+        versions = self.core.get_versions(self.device)
+        key = hashlib.sha256(
+            repr(
+                (
+                    file_hash,
+                    self.uint8_io,
+                    size,
+                    self.device,
+                    sorted(self.conf.items()),
+                    sorted((k, v.build_number) for k, v in versions.items()),
+                )
+            ).encode()
+        ).hexdigest()
+        return os.path.join(self.cache_dir, key + ".blob")
+
+    def _load(self, style, size):
+        """Compile style for input size (height, width), or for the size of
+        the IR when size is None. Compiled models are exported to and imported
+        from cache_dir."""
+        blob_path = None
+        if self.cache_dir:
+            blob_path = self._blob_path(style, size)
+            if os.path.isfile(blob_path):
+                try:
+                    with open(blob_path, "rb") as f:
+                        exec_net = self.core.import_model(
+                            f.read(), self.device, self.conf
+                        )
+                    logger.info("Loaded %s from %s", style, blob_path)
+                    self._count("imports")
+                    return exec_net
+                except Exception as e:
+                    logger.warning("Could not load %s: %s", blob_path, e)
+
+        net = self._net(style)
+        with self._compile_lock:
+            if size is not None and self._input_hw(net) != size:
+                logger.info("Network reshaped to %s", str(size))
+                h, w = size
+                net.reshape(
+                    PartialShape([1, h, w, 3] if self.uint8_io else [1, 3, h, w])
+                )
+                self._count("reshapes")
+            exec_net = self.core.compile_model(net, self.device, self.conf)
+        self._count("compiles")
+
+        if blob_path is not None:
+            tmp_path = "{}.{}.tmp".format(blob_path, os.getpid())
+            try:
+                blob = exec_net.export_model()
+                # Newer releases return a BytesIO
+                blob = getattr(blob, "getvalue", lambda: blob)()
+                with open(tmp_path, "wb") as f:
+                    f.write(blob)
+                os.replace(tmp_path, blob_path)
+            except Exception as e:
+                logger.warning("Could not save compiled model for %s: %s", style, e)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return exec_net
+
+    def _compiled(self, style, size):
+        """Compiled model and infer request pool for style at input size
+        (height, width), or at the size of the IR when size is None."""
+
+        def load():
+            exec_net = self._load(style, size)
+            if size is None:
+                self._input_sizes[style] = self._input_hw(exec_net)
+
+            # jobs=0 lets the device pick the optimal number of requests
+            infer_queue = AsyncInferQueue(exec_net, 0)
+            infer_queue.set_callback(_on_complete)
+            return exec_net, infer_queue
+
+        def unload(compiled):
+            _, infer_queue = compiled
+            infer_queue.wait_all()
+
+        return self.compiled_models.get((style, size, self.device), load, unload)
+
+    def _warm(self, keys):
+        """Load (style, size) pairs in the background while there is room in
+        the cache. With cache_dir, the remaining pairs are compiled and saved,
+        so that switching to them later only has to load the saved model."""
+        start = time.time()
+        for style, size in keys:
+            try:
+                if self.compiled_models.has_room():
+                    self._compiled(style, size)
+                elif self.cache_dir and not os.path.isfile(
+                    self._blob_path(style, size)
+                ):
+                    self._load(style, size)
+            except Exception:
+                logger.exception("Could not load style %s at %s", style, size)
+        logger.info("Finished loading styles in %.1f s", time.time() - start)
+
+    def _input_size(self, style):
+        """(height, width) of the IR for style."""
+        size = self._input_sizes.get(style)
+        if size is None:
+            exec_net, _ = self._compiled(style, None)
+            size = self._input_hw(exec_net)
+        return size
+
+    def get_input_size(self, style=None):
+        if self.use_reshape:
+            return None
+
+        h, w = self._input_size(self._resolve_style(style))
+        return w, h
+
+    def preprocessing(self, img, style=None):
+        style = self._resolve_style(style)
+        if self.use_reshape:
+            frame, valid = self._snap(img)
+        else:
+            h, w = self._input_size(style)
+            frame = img[np.newaxis]
+            if img.shape[:-1] != (h, w):
                 logger.debug(
                     "Image is resized from %s to %s", str(img.shape[:-1]), str((h, w))
                 )
-                img = cv2.resize(img, (w, h))
-        if exec_net is None or reshaped:
-            if len(self.lru_style) == 0 or self.lru_style[0] != style:
-                if style in self.lru_style:
-                    self.lru_style.remove(style)
-                self.lru_style.insert(0, style)
-            if len(self.lru_style) > self.max_lru:
-                oldstyle = self.lru_style.pop()
-                self.nets[oldstyle] = (self.nets[oldstyle][0], None)
-            logger.info("Loading model to the plugin")
-            self.nets[self.get_style()] = (
-                net,
-                self.plugin.load(network=net, config=self.conf),
-            )
-            if exec_net is not None:
-                del exec_net
-        img = img.transpose((2, 0, 1))  # Change data layout from HWC to CHW
-        img = np.float32(img) * (1.0 / 255.0)  # convert to float
-        return [img]
-
-    def inference(self, preprocessed):
-        return self.nets[self.get_style()][1].infer(
-            inputs={self.input_blob: preprocessed}
+                frame = self._frames.acquire((1, h, w, 3))
+                cv2.resize(img, (w, h), dst=frame[0])
+            valid = (h, w)
+        if self.uint8_io:
+            return _Input(frame, valid)
+
+        # Change data layout from HWC to CHW and convert to float
+        tensor = self._tensors.acquire((1, 3) + frame.shape[1:3])
+        np.multiply(
+            frame[0].transpose((2, 0, 1)), 1.0 / 255.0, out=tensor[0], dtype=np.float32
         )
+        self._frames.release(frame)
+        return _Input(tensor, valid)
+
+    def _bucket(self, h, w):
+        """Smallest bucket that an h by w image fits in. If there is none, the
+        bucket that the image can be scaled down to fit at the largest size."""
+        bucket = self._buckets_by_size.get((h, w))
+        if bucket is None:
+            fits = [b for b in self.buckets if b[0] >= h and b[1] >= w]
+            if fits:
+                bucket = fits[0]
+            else:
+                bucket = max(self.buckets, key=lambda b: min(b[0] / h, b[1] / w))
+            self._buckets_by_size[(h, w)] = bucket
+        return bucket
+
+    def _snap(self, img):
+        """Pad, and scale down if needed, img to its bucket. Return the padded
+        image with a batch axis, and the (height, width) of the part that is
+        not padding."""
+        h, w = img.shape[:2]
+        bucket_h, bucket_w = self._bucket(h, w)
+        frame = img[np.newaxis]
+        if (h, w) != (bucket_h, bucket_w):
+            frame = self._frames.acquire((1, bucket_h, bucket_w, 3))
+
+        scale = min(bucket_h / h, bucket_w / w)
+        if scale < 1:
+            w = min(max(int(round(w * scale)), 1), bucket_w)
+            h = min(max(int(round(h * scale)), 1), bucket_h)
+            # Resize straight into the frame when there is nothing to pad
+            dst = frame[0] if (h, w) == (bucket_h, bucket_w) else None
+            img = cv2.resize(img, (w, h), dst=dst, interpolation=cv2.INTER_AREA)
+
+        if (h, w) != (bucket_h, bucket_w):
+            # Reflecting the edges keeps the border of the output clean
+            cv2.copyMakeBorder(
+                img,
+                0,
+                bucket_h - h,
+                0,
+                bucket_w - w,
+                cv2.BORDER_REFLECT_101,
+                dst=frame[0],
+            )
+
+        with self._stats_lock:
+            self.bucket_frames[(bucket_h, bucket_w)] += 1
+            if scale < 1:
+                self.scaled_frames += 1
+            elif (h, w) != (bucket_h, bucket_w):
+                self.padded_frames += 1
+        return frame, (h, w)
+
+    def inference(self, preprocessed, style=None):
+        return self.inference_batch([preprocessed], style)[0]
+
+    def inference_batch(self, preprocessed_batch, style=None):
+        done = threading.Event()
+        results = []
+        errors = []
+
+        def callback(post_inference):
+            results.extend(post_inference)
+            done.set()
+
+        def errback(error):
+            errors.append(error)
+            done.set()
+
+        self.inference_async(preprocessed_batch, callback, style, errback)
+        if not done.wait(INFERENCE_TIMEOUT):
+            raise RuntimeError(
+                "Inference did not finish in {} s".format(INFERENCE_TIMEOUT)
+            )
+        if errors:
+            raise errors[0]
+        return results
+
+    def inference_async(self, preprocessed_batch, callback, style=None, errback=None):
+        if len(preprocessed_batch) == 0:
+            callback([])
+            return
+
+        size = None
+        if self.use_reshape:
+            size = self._hw(preprocessed_batch[0].tensor.shape)
+        style = self._resolve_style(style)
+        _, infer_queue = self._compiled(style, size)
+        pool = self._frames if self.uint8_io else self._tensors
+
+        def finished(outputs):
+            for preprocessed in preprocessed_batch:
+                pool.release(preprocessed.tensor)
+            callback(outputs)
+
+        def failed(error):
+            for preprocessed in preprocessed_batch:
+                pool.release(preprocessed.tensor)
+            if errback is None:
+                logger.error("Inference failed: %s", error)
+            else:
+                errback(error)
+
+        batch = _Batch(len(preprocessed_batch), finished, failed)
+        for i, preprocessed in enumerate(preprocessed_batch):
+            h, w = preprocessed.valid
+            if self.uint8_io:
+                crop = (slice(None), slice(h), slice(w))
+            else:
+                crop = (slice(None), slice(None), slice(h), slice(w))
+            try:
+                infer_queue.start_async({0: preprocessed.tensor}, (batch, i, crop))
+            except Exception as e:
+                # The request that could not start is never returned to the
+                # queue, so compile a new one for the next frame
+                self.compiled_models.discard((style, size, self.device))
+                # Requests that were not started will never call back
+                for _ in range(i, len(preprocessed_batch)):
+                    batch.set_error(e)
+                break
+        self._log_stats()
 
     def postprocessing(self, post_inference):
-        img_out = post_inference[self.out_blob][0]
+        if self.uint8_io:
+            return post_inference[0]
+
+        img_out = post_inference[0]
         img_out = img_out.transpose(1, 2, 0)
-        img_out = np.clip(img_out, 0, 255)
+        # Outputs are copies of the request's output, so clip them in place
+        img_out = np.clip(img_out, 0, 255, out=img_out)
 
         return img_out
+
+    def _hw(self, shape):
+        """(height, width) of an NCHW, or with uint8_io NHWC, shape."""
+        if self.uint8_io:
+            _, h, w, _ = shape
+        else:
+            _, _, h, w = shape
+        return h, w
+
+    def _input_hw(self, net):
+        return self._hw(net.input(0).get_shape())
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get_stats(self):
+        """Counts of compiled models and frames per bucket, with the stats of
+        the compiled model cache."""
+        with self._stats_lock:
+            stats = {
+                "compiles": self.compiles,
+                "reshapes": self.reshapes,
+                "imports": self.imports,
+                "padded_frames": self.padded_frames,
+                "scaled_frames": self.scaled_frames,
+                "bucket_frames": dict(self.bucket_frames),
+            }
+        stats["cache"] = self.compiled_models.get_stats()
+        return stats
+
+    def _log_stats(self):
+        now = time.time()
+        if now - self._lastprint < STATS_INTERVAL:
+            return
+
+        self._lastprint = now
+        stats = self.get_stats()
+        logger.info(
+            "OpenVINO models: %d compiled (%d reshaped), %d loaded from disk, "
+            "%d cached, %d evicted",
+            stats["compiles"],
+            stats["reshapes"],
+            stats["imports"],
+            stats["cache"]["entries"],
+            stats["cache"]["evictions"],
+        )
+        if self.use_reshape:
+            logger.info(
+                "Frames per bucket: %s. %d padded, %d scaled down",
+                ", ".join(
+                    "{}x{} {}".format(w, h, count)
+                    for (h, w), count in stats["bucket_frames"].items()
+                ),
+                stats["padded_frames"],
+                stats["scaled_frames"],
+            )
+
+
+def _area(size):
+    return size[0] * size[1]
+
+
+def _with_uint8_io(net):
+    """net with uint8 BGR NHWC input and uint8 NHWC output."""
+    ppp = PrePostProcessor(net)
+    ppp.input().tensor().set_element_type(Type.u8).set_layout(
+        Layout("NHWC")
+    ).set_color_format(ColorFormat.BGR)
+    ppp.input().model().set_layout(Layout("NCHW"))
+    ppp.input().preprocess().convert_element_type(Type.f32).convert_color(
+        ColorFormat.RGB
+    ).scale(255.0)
+
+    # Clip and truncate like the float path, then convert
+    ppp.output().model().set_layout(Layout("NCHW"))
+    ppp.output().tensor().set_layout(Layout("NHWC")).set_element_type(Type.u8)
+    ppp.output().postprocess().custom(
+        lambda output: ops.floor(ops.clamp(output, 0.0, 255.0)).output(0)
+    )
+    return ppp.build()
+
+
+class _Batch:
+    """Collects the outputs of the infer requests for one batch. Once every
+    request is done, callback is called with the outputs, or errback with
+    the first error if any request failed."""
+
+    def __init__(self, size, callback, errback):
+        self.outputs = [None] * size
+        self.error = None
+        self._remaining = size
+        self._callback = callback
+        self._errback = errback
+        self._lock = threading.Lock()
+
+    def set_output(self, i, output):
+        self.outputs[i] = output
+        self._done_one()
+
+    def set_error(self, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+        self._done_one()
+
+    def _done_one(self):
+        with self._lock:
+            self._remaining -= 1
+            finished = self._remaining == 0
+        if not finished:
+            return
+        if self.error is None:
+            self._callback(self.outputs)
+        else:
+            self._errback(self.error)
+
+
+def _on_complete(request, userdata):
+    batch, i, crop = userdata
+    try:
+        # The request's output tensor is reused by the next frame
+        output = request.get_output_tensor(0).data[crop].copy()
+    except Exception as e:
+        logger.exception("Could not get inference result")
+        batch.set_error(e)
+        return
+    batch.set_output(i, output)
@@ -0,0 +1,308 @@
+from openrtist.openrtist_engine import OpenrtistEngine
+from gabriel_protocol import gabriel_pb2
+from gabriel_server.cognitive_engine import CognitiveEngine
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STATS_INTERVAL = 5
+
+
+class _Job:
+    """Results for one call to handle_batch or handle_batch_async. on_done is
+    called with the job once, when every frame has a result or as soon as
+    one of them fails."""
+
+    def __init__(self, num_frames, on_done):
+        self.results = [None] * num_frames
+        self.error = None
+        self._remaining = num_frames
+        self._on_done = on_done
+        self._finished = False
+        self._lock = threading.Lock()
+        if num_frames == 0:
+            self._finish()
+
+    def set_result(self, i, result_wrapper):
+        self.results[i] = result_wrapper
+        with self._lock:
+            self._remaining -= 1
+            finished = self._remaining == 0
+        if finished:
+            self._finish()
+
+    def set_error(self, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self._on_done(self)
+
+
+class _Stage:
+    """A worker thread that takes items off a queue. If work raises, fail is
+    called with the item and the exception. By default it fails the job
+    that the item starts with."""
+
+    def __init__(self, name, work, input_queue, fail=None):
+        self.name = name
+        self.input_queue = input_queue
+        self._work = work
+        self._fail = fail or (lambda item, error: item[0].set_error(error))
+        self.busy = 0.0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def send(self, next_stage, item):
+        """Pass item to next_stage. Time spent waiting for room in its queue
+        does not count as busy time for this stage. This can also be called
+        from threads that are not part of the pipeline."""
+        start = time.time()
+        next_stage.input_queue.put(item)
+        if threading.current_thread() is self._thread:
+            self.busy -= time.time() - start
+
+    def _run(self):
+        while True:
+            item = self.input_queue.get()
+            start = time.time()
+            try:
+                self._work(item)
+            except Exception as e:
+                logger.exception("Error in %s stage", self.name)
+                self._fail(item, e)
+            self.busy += time.time() - start
+
+
+class PipelinedEngine(OpenrtistEngine):
+    """Runs decoding, inference, and encoding on separate threads, so that
+    one frame can be decoded while another is in inference and a third is
+    being encoded. Results of inference are postprocessed on a thread of
+    their own, so adapters can hand them over without waiting. OpenCV and
+    the inference backends release the GIL while they work.
+
+    Frames that are waiting for inference together and share a style and
+    resolution are run as one batch of at most max_batch_size frames. With
+    adapters that run inference asynchronously, several batches can be in
+    flight at once.
+
+    Frames from different calls only overlap when they come in through
+    handle_batch_async, which LocalEngine uses when it sends a worker
+    several batches at once."""
+
+    def __init__(
+        self, compression_params, adapter, max_batch_size=1, queue_size=4, **kwargs
+    ):
+        super().__init__(compression_params, adapter, **kwargs)
+        self.max_batch_size = max(1, max_batch_size)
+
+        self._decode_stage = _Stage("decode", self._decode, queue.Queue(queue_size))
+        self._infer_stage = _Stage("infer", self._infer, queue.Queue(queue_size))
+        # Adapters hand finished inference to this stage from their own
+        # threads, which must not block, so its queue is unbounded. How much
+        # is in flight is bounded by the queues before it.
+        self._postprocess_stage = _Stage(
+            "postprocess",
+            self._postprocess,
+            queue.Queue(),
+            lambda item, error: self._fail_group(item[0], error),
+        )
+        self._encode_stage = _Stage("encode", self._encode, queue.Queue(queue_size))
+        self._stages = [
+            self._decode_stage,
+            self._infer_stage,
+            self._postprocess_stage,
+            self._encode_stage,
+        ]
+
+        self._lastprint = time.time()
+        self._last_busy = [0.0] * len(self._stages)
+
+    def handle(self, input_frame):
+        return self.handle_batch([input_frame])[0]
+
+    def handle_batch(self, input_frames, client_ids=None):
+        done = threading.Event()
+        job = _Job(len(input_frames), lambda job: done.set())
+        self._start(job, input_frames, client_ids)
+        done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.results
+
+    def handle_batch_async(self, input_frames, callback, client_ids=None):
+        """Start the frames down the pipeline and return, so that the next
+        batch can be decoded while this one is in inference. Frames of a
+        batch that fails get ENGINE_ERROR results."""
+
+        def done(job):
+            if job.error is None:
+                callback(job.results)
+                return
+
+            status = gabriel_pb2.ResultWrapper.Status.ENGINE_ERROR
+            callback(
+                [CognitiveEngine.create_result_wrapper(status) for _ in input_frames]
+            )
+
+        self._start(_Job(len(input_frames), done), input_frames, client_ids)
+
+    def _start(self, job, input_frames, client_ids):
+        for i, input_frame in enumerate(input_frames):
+            client_id = None if client_ids is None else client_ids[i]
+            self._decode_stage.input_queue.put((job, i, input_frame, client_id))
+        self._log_occupancy()
+
+    def get_occupancy(self):
+        """Fraction of time each stage spent working since the last report."""
+        now = time.time()
+        elapsed = max(now - self._lastprint, 1e-9)
+        occupancy = {}
+        for i, stage in enumerate(self._stages):
+            busy = stage.busy
+            occupancy[stage.name] = (busy - self._last_busy[i]) / elapsed
+            self._last_busy[i] = busy
+        self._lastprint = now
+        return occupancy
+
+    def _log_occupancy(self):
+        if time.time() - self._lastprint < STATS_INTERVAL:
+            return
+
+        occupancy = self.get_occupancy()
+        logger.info(
+            "Stage occupancy: %s",
+            ", ".join(
+                "{} {:.0f}%".format(name, 100 * value)
+                for name, value in occupancy.items()
+            ),
+        )
+
+    def _decode(self, item):
+        job, i, input_frame, client_id = item
+        if input_frame.payload_type != gabriel_pb2.PayloadType.IMAGE:
+            job.set_result(i, self._wrong_input_format())
+            return
+
+        frame = self._prepare(input_frame, client_id)
+        image = frame.orig_img
+        if frame.style:
+            image = self._reuse(frame)
+            if image is None:
+                self._decode_stage.send(self._infer_stage, (job, i, frame))
+                return
+
+        self._decode_stage.send(self._encode_stage, (job, i, frame, image))
+
+    def _infer(self, item):
+        """Run item, together with any waiting items that share its style and
+        resolution, through the adapter. If the adapter can mix styles in a
+        batch, only the resolution has to match."""
+        group = [item]
+        while True:
+            next_item = None
+            if len(group) < self.max_batch_size:
+                try:
+                    next_item = self._infer_stage.input_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+            same_group = next_item is not None and (
+                self._group_key(next_item) == self._group_key(group[0])
+            )
+            if same_group:
+                group.append(next_item)
+                continue
+
+            self._submit(group)
+
+            if next_item is None:
+                return
+            group = [next_item]
+
+    def _submit(self, group):
+        """Start inference on a group. Adapters that keep several frames in
+        flight finish it in the background, while this stage goes on to the
+        next group. Tiled frames are finished before this returns. If the
+        group cannot be started, every job in it fails."""
+        try:
+            self._start_inference(group)
+        except Exception as e:
+            logger.exception("Error in infer stage")
+            self._fail_group(group, e)
+
+    def _start_inference(self, group):
+        if self._tiled(group[0][2].input_img, group[0][2].style):
+            style = group[0][2].style
+            if self.adapter.mixed_style_batches:
+                style = [frame.style for _, _, frame in group]
+            images = self.process_images(
+                [frame.input_img for _, _, frame in group], style
+            )
+            for (job, i, frame), image in zip(group, images):
+                self._remember(frame, image)
+                self._infer_stage.send(self._encode_stage, (job, i, frame, image))
+            return
+
+        # A frame that cannot be preprocessed only fails its own job
+        preprocessed = []
+        for item in group[:]:
+            frame = item[2]
+            try:
+                preprocessed.append(
+                    self.adapter.preprocessing(frame.input_img, frame.style)
+                )
+            except Exception as e:
+                logger.exception("Could not preprocess a frame")
+                item[0].set_error(e)
+                group.remove(item)
+        if not group:
+            return
+
+        style = group[0][2].style
+        if self.adapter.mixed_style_batches:
+            style = [frame.style for _, _, frame in group]
+
+        def done(post_inference):
+            self._postprocess_stage.input_queue.put_nowait(
+                (group, post_inference, None)
+            )
+
+        def failed(error):
+            self._postprocess_stage.input_queue.put_nowait((group, None, error))
+
+        self.adapter.inference_async(preprocessed, done, style, errback=failed)
+
+    def _postprocess(self, item):
+        group, post_inference, error = item
+        if error is not None:
+            self._fail_group(group, error)
+            return
+
+        for (job, i, frame), p in zip(group, post_inference):
+            image = self.adapter.postprocessing(p)
+            self._remember(frame, image)
+            self._postprocess_stage.send(self._encode_stage, (job, i, frame, image))
+
+    def _fail_group(self, group, error):
+        for job, _, _ in group:
+            job.set_error(error)
+
+    def _group_key(self, item):
+        frame = item[2]
+        if self.adapter.mixed_style_batches:
+            return frame.input_img.shape
+        return frame.style, frame.input_img.shape
+
+    def _encode(self, item):
+        job, i, frame, image = item
+        job.set_result(i, self._finish(frame, image))
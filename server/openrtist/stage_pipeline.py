@@ -0,0 +1,385 @@
+import atexit
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from openrtist.cpu_partition import available_cores, pin, split_cores
+from openrtist.transformer_net import TransformerNet
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+logger = logging.getLogger(__name__)
+
+# Frame shapes that each link between processes keeps buffers for
+MAX_SHAPES = 4
+
+
+class StagePipeline:
+    """Runs TransformerNets split into stages, each in its own process, so
+    that one stage can work on a frame while the next one finishes the frame
+    before it.
+
+    Stage processes load each style from path/<style>.model, split it with
+    TransformerNet.stages(boundaries), and keep their own part, passed
+    through prepare if it is given. Each process keeps max_resident styles
+    loaded and runs num_threads Torch threads, by default an equal share of
+    the cores that this process may run on. With pin, those cores are split
+    between the stages, and each stage process is pinned to its share.
+
+    Activations pass between processes through shared memory, in NHWC
+    layout with channels_last. Each frame in the pipeline has its own
+    buffers, so a stage never waits for the next one to read its output. Up
+    to depth frames, by default one more than the number of stages, are in
+    the pipeline at once, and callers wait for room beyond that."""
+
+    def __init__(
+        self,
+        path,
+        boundaries,
+        prepare=None,
+        max_resident=4,
+        num_threads=None,
+        channels_last=False,
+        depth=None,
+        pin=False,
+    ):
+        if shared_memory is None:
+            raise RuntimeError("Pipeline stages need Python 3.8 or newer")
+
+        num_stages = len(TransformerNet().stages(boundaries))
+        cores = available_cores()
+        if pin:
+            core_sets = split_cores(cores, num_stages)
+        else:
+            core_sets = [None] * num_stages
+        if depth is None:
+            depth = num_stages + 1
+
+        # Stage processes import Torch themselves instead of inheriting its
+        # thread pools from this process
+        context = multiprocessing.get_context("spawn")
+        # From this process to the first stage, between stages, and from the
+        # last stage back
+        links = [context.Pipe(duplex=False) for _ in range(num_stages + 1)]
+        self._processes = []
+        for index, stage_cores in enumerate(core_sets):
+            threads = num_threads
+            if threads is None and pin:
+                threads = len(stage_cores)
+            elif threads is None:
+                threads = max(1, len(cores) // num_stages)
+            process = context.Process(
+                target=_run_stage,
+                args=(
+                    index,
+                    boundaries,
+                    path,
+                    prepare,
+                    max_resident,
+                    threads,
+                    stage_cores,
+                    channels_last,
+                    depth,
+                    links[index][0],
+                    links[index + 1][1],
+                ),
+                name="stage{}".format(index),
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+        # Only the stage processes should hold the other ends, so that we get
+        # EOF if one of them dies
+        self._receiver = links[-1][0]
+        self._sender = links[0][1]
+        for receiver, sender in links:
+            if receiver is not self._receiver:
+                receiver.close()
+            if sender is not self._sender:
+                sender.close()
+
+        self._inputs = _Buffers(channels_last, depth, owner=True)
+        self._outputs = _Buffers(channels_last, depth, owner=False)
+        self._slots = queue.Queue()
+        for slot in range(depth):
+            self._slots.put(slot)
+        self._frame_ids = itertools.count()
+        # frame id -> (_Results, index in them, slot)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        # Set once frames can no longer go through, after close or when a
+        # stage has died
+        self._stopped = False
+        threading.Thread(target=self._receive, name="stages", daemon=True).start()
+        logger.info("Started %d pipeline stages", num_stages)
+        atexit.register(self.close)
+
+    def close(self):
+        """Stop the stage processes once they finish the frames they have,
+        and free the shared memory."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = self._stopped = True
+            # Each stage exits when the one before it closes its connection
+            self._sender.close()
+        for process in self._processes:
+            process.join()
+        with self._lock:
+            self._inputs.close()
+
+    def run(self, style, batch):
+        """Run style on batch, an NCHW tensor, and return the outputs as an
+        NCHW float32 array."""
+        done = threading.Event()
+        results = []
+
+        def callback(outputs):
+            results.extend(outputs)
+            done.set()
+
+        self.run_async(style, list(batch.split(1)), callback)
+        done.wait()
+        if any(output is None for output in results):
+            raise RuntimeError("Pipeline stages could not run " + style)
+        return np.stack(results)
+
+    def run_async(self, style, frames, callback):
+        """Start running style on frames, a list of 1xCxHxW tensors, and call
+        callback with the list of outputs, as CHW float32 arrays. Outputs of
+        frames that failed are None. The frames can be reused once this
+        returns. Raises RuntimeError if the stages have stopped."""
+        results = _Results(len(frames), callback)
+        for i, frame in enumerate(frames):
+            slot = self._slots.get()
+            shape = tuple(frame.shape)
+            with self._lock:
+                if self._stopped:
+                    self._slots.put(slot)
+                    raise RuntimeError("Pipeline stages have stopped")
+                buffer, name = self._inputs.create(slot, shape)
+                torch.from_numpy(buffer).copy_(frame)
+                frame_id = next(self._frame_ids)
+                self._pending[frame_id] = results, i, slot
+                self._sender.send((frame_id, slot, style, name, shape))
+
+    def _receive(self):
+        while True:
+            try:
+                frame_id, slot, _, name, shape = self._receiver.recv()
+            except (EOFError, OSError):
+                if not self._closed:
+                    logger.error("A pipeline stage exited")
+                break
+
+            output = None
+            if name is not None:
+                try:
+                    # The buffer is reused by the next frame in this slot
+                    output = np.array(self._outputs.attach(name, shape)[0])
+                except (OSError, ValueError):
+                    logger.exception("Could not read the output of a stage")
+            with self._lock:
+                results, i, _ = self._pending.pop(frame_id)
+            self._slots.put(slot)
+            results.set_output(i, output)
+
+        with self._lock:
+            self._stopped = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for results, i, slot in pending:
+            self._slots.put(slot)
+            results.set_output(i, None)
+
+
+class _Results:
+    """Collects the outputs for one call to run_async."""
+
+    def __init__(self, size, callback):
+        self.outputs = [None] * size
+        self._remaining = size
+        self._callback = callback
+        self._lock = threading.Lock()
+        if size == 0:
+            callback([])
+
+    def set_output(self, i, output):
+        self.outputs[i] = output
+        with self._lock:
+            self._remaining -= 1
+            finished = self._remaining == 0
+        if finished:
+            self._callback(self.outputs)
+
+
+class _Buffers:
+    """Shared memory for the activations on one link between processes.
+
+    The owner writes to the link and creates a buffer for each slot and
+    shape. The other process reads from it, and attaches to buffers by
+    name. Buffers are float32 arrays seen in NCHW order.
+
+    A slot is only written again once its last frame is through the whole
+    pipeline, so every reader has attached to that frame's buffer by then.
+    The owner therefore only frees buffers of the slot that it is writing,
+    and never those of frames still in flight."""
+
+    def __init__(self, channels_last, depth, owner):
+        self._channels_last = channels_last
+        self._capacity = depth * MAX_SHAPES
+        self._owner = owner
+        # (slot, shape) for the owner, or name for the reader ->
+        # (shared memory, array), least recently used first
+        self._buffers = OrderedDict()
+
+    def create(self, slot, shape):
+        """Array of shape for slot, and the name of its shared memory."""
+        key = slot, shape
+        entry = self._buffers.get(key)
+        if entry is None:
+            in_slot = [k for k in self._buffers if k[0] == slot]
+            if len(in_slot) >= MAX_SHAPES:
+                self._evict(in_slot[0])
+            size = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            entry = self._add(key, shm, shape)
+        self._buffers.move_to_end(key)
+        shm, array = entry
+        return array, shm.name
+
+    def attach(self, name, shape):
+        entry = self._buffers.get(name)
+        if entry is None:
+            entry = self._add(name, shared_memory.SharedMemory(name=name), shape)
+        self._buffers.move_to_end(name)
+        return entry[1]
+
+    def close(self):
+        while self._buffers:
+            self._evict()
+
+    def _add(self, key, shm, shape):
+        if not self._owner and len(self._buffers) >= self._capacity:
+            self._evict()
+
+        n, c, h, w = shape
+        if self._channels_last:
+            array = np.ndarray((n, h, w, c), np.float32, shm.buf)
+            array = array.transpose(0, 3, 1, 2)
+        else:
+            array = np.ndarray(shape, np.float32, shm.buf)
+        entry = self._buffers[key] = shm, array
+        return entry
+
+    def _evict(self, key=None):
+        """Free the buffer for key, by default the least recently used."""
+        if key is None:
+            _, (shm, array) = self._buffers.popitem(last=False)
+        else:
+            shm, array = self._buffers.pop(key)
+        # Memory can only be closed once nothing views it
+        del array
+        shm.close()
+        if self._owner:
+            shm.unlink()
+
+
+class _StageModels:
+    """The part of each style's network that one stage runs, for up to
+    max_resident styles, least recently used first."""
+
+    def __init__(self, index, boundaries, path, prepare, max_resident):
+        self.index = index
+        self._boundaries = boundaries
+        self._path = path
+        self._prepare = prepare
+        self._max_resident = max(1, max_resident)
+        self._models = OrderedDict()
+
+    def get(self, style):
+        model = self._models.get(style)
+        if model is not None:
+            self._models.move_to_end(style)
+            return model
+
+        if len(self._models) >= self._max_resident:
+            old_style, _ = self._models.popitem(last=False)
+            logger.debug("Stage %d unloading style %s", self.index, old_style)
+
+        net = TransformerNet()
+        net.load_state_dict(torch.load(os.path.join(self._path, style + ".model")))
+        net.eval()
+        model = net.stages(self._boundaries)[self.index]
+        if self._prepare is not None:
+            model = self._prepare(model)
+        self._models[style] = model
+        return model
+
+
+def _run_stage(
+    index,
+    boundaries,
+    path,
+    prepare,
+    max_resident,
+    num_threads,
+    cores,
+    channels_last,
+    depth,
+    receiver,
+    sender,
+):
+    if cores is not None:
+        pin(cores)
+    torch.set_grad_enabled(False)
+    torch.set_num_threads(num_threads)
+    models = _StageModels(index, boundaries, path, prepare, max_resident)
+    inputs = _Buffers(channels_last, depth, owner=False)
+    outputs = _Buffers(channels_last, depth, owner=True)
+    logger.info("Pipeline stage %d started in process %d", index, os.getpid())
+    try:
+        while True:
+            try:
+                frame_id, slot, style, name, shape = receiver.recv()
+            except EOFError:
+                return
+
+            if name is not None:
+                try:
+                    name, shape = _run_frame(
+                        models.get(style), inputs.attach(name, shape), outputs, slot
+                    )
+                except Exception:
+                    logger.exception("Stage %d could not run %s", index, style)
+                    name = None
+            try:
+                sender.send((frame_id, slot, style, name, shape))
+            except BrokenPipeError:
+                # The next stage has exited
+                return
+    finally:
+        inputs.close()
+        outputs.close()
+
+
+def _run_frame(model, frame, outputs, slot):
+    """Run model on frame, and write its output to the buffer for slot in
+    outputs. Returns the name and shape of the output."""
+    output = model(torch.from_numpy(frame))
+    shape = tuple(output.shape)
+    buffer, name = outputs.create(slot, shape)
+    torch.from_numpy(buffer).copy_(output)
+    return name, shape
@@ -0,0 +1,82 @@
+import cv2
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (32, 24)
+DEFAULT_MAX_CLIENTS = 64
+STATS_INTERVAL = 5
+
+
+class TemporalCache:
+    """Remembers the last stylized image for each client, so that frames that
+    barely differ from the one it came from can skip inference.
+
+    Frames are compared on small thumbnails by their mean absolute
+    difference, in pixel values from 0 to 255. A frame whose difference is
+    at most threshold reuses the stored image. The comparison is always
+    against the frame that was actually stylized, so slow drift eventually
+    causes a miss."""
+
+    def __init__(self, threshold, max_clients=DEFAULT_MAX_CLIENTS):
+        self.threshold = threshold
+        self.max_clients = max_clients
+        self.hits = 0
+        self.misses = 0
+
+        # client_id -> (style, shape, thumbnail, image), least recent first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._lastprint = time.time()
+
+    @staticmethod
+    def thumbnail(img):
+        return cv2.resize(img, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+    def lookup(self, client_id, style, img, thumbnail):
+        """Return the stored image for client_id if it was made from a frame
+        like img with the same style, otherwise None."""
+        with self._lock:
+            entry = self._entries.get(client_id)
+
+        image = None
+        if entry is not None:
+            cached_style, shape, cached_thumbnail, cached_image = entry
+            if (
+                cached_style == style
+                and shape == img.shape
+                and cv2.absdiff(thumbnail, cached_thumbnail).mean() <= self.threshold
+            ):
+                image = cached_image
+
+        with self._lock:
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._log_stats()
+        return image
+
+    def store(self, client_id, style, img, thumbnail, image):
+        with self._lock:
+            self._entries[client_id] = (style, img.shape, thumbnail, image)
+            self._entries.move_to_end(client_id)
+            while len(self._entries) > self.max_clients:
+                self._entries.popitem(last=False)
+
+    def _log_stats(self):
+        now = time.time()
+        if now - self._lastprint < STATS_INTERVAL:
+            return
+
+        self._lastprint = now
+        total = self.hits + self.misses
+        logger.info(
+            "Temporal cache: %d hits, %d misses (%.0f%% hit rate)",
+            self.hits,
+            self.misses,
+            100 * self.hits / max(total, 1),
+        )
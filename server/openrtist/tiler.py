@@ -0,0 +1,100 @@
+import math
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Pixels that neighbouring tiles share. TransformerNet sees about 54 pixels
+# around each output pixel, so results agree closely in the middle of this
+# strip, where the tiles are blended.
+DEFAULT_OVERLAP = 64
+
+
+class Tiler:
+    """Runs frames larger than tile_size through the network as overlapping
+    tiles of tile_size, and blends the results back together.
+
+    Tiles are no larger than they need to be to cover the frame, and every
+    tile of a frame has the same size, so adapters that compile a model per
+    input size compile it once. Where two tiles overlap, each is weighted
+    by how far the pixel is from its edge, which hides the seams. With
+    num_threads > 0, tiles run on a thread pool."""
+
+    def __init__(self, tile_size, overlap=DEFAULT_OVERLAP, num_threads=0):
+        # TransformerNet returns the input size for multiples of 4
+        self.tile_size = tile_size // 4 * 4
+        self.overlap = overlap
+        if self.tile_size <= overlap:
+            raise ValueError("Tiles must be larger than their overlap")
+        self._executor = None
+        if num_threads > 0:
+            self._executor = ThreadPoolExecutor(num_threads, thread_name_prefix="tile")
+        # Frame shape -> (tile windows, blending weights)
+        self._layouts = {}
+
+    def applies(self, image):
+        """Whether image is large enough to be split into tiles."""
+        height, width = image.shape[:2]
+        return height > self.tile_size or width > self.tile_size
+
+    def run(self, image, fn):
+        """Stylize image by calling fn on each tile, and return the blended
+        float32 result."""
+        windows, weights = self._tiles(image.shape)
+
+        def run_tile(window):
+            y0, y1, x0, x1 = window
+            return fn(image[y0:y1, x0:x1])
+
+        if self._executor is None:
+            outputs = [run_tile(window) for window in windows]
+        else:
+            outputs = list(self._executor.map(run_tile, windows))
+
+        height, width = image.shape[:2]
+        result = np.zeros((height, width, outputs[0].shape[2]), np.float32)
+        for (y0, y1, x0, x1), output, weight in zip(windows, outputs, weights):
+            # Sides that are not multiples of 4 come back a little larger
+            result[y0:y1, x0:x1] += output[: y1 - y0, : x1 - x0] * weight
+        return result
+
+    def _tiles(self, shape):
+        layout = self._layouts.get(shape)
+        if layout is None:
+            height, width = shape[:2]
+            rows = self._spans(height)
+            columns = self._spans(width)
+            windows = [(y0, y1, x0, x1) for y0, y1 in rows for x0, x1 in columns]
+            layout = windows, self._weights(height, width, windows)
+            self._layouts[shape] = layout
+        return layout
+
+    def _spans(self, length):
+        """(start, end) of the fewest tiles along an axis that cover it,
+        made as small as they can be and evenly spread."""
+        if length <= self.tile_size:
+            return [(0, length)]
+        count = math.ceil((length - self.overlap) / (self.tile_size - self.overlap))
+        size = math.ceil((length + (count - 1) * self.overlap) / count)
+        size = min(-(-size // 4) * 4, self.tile_size)
+        last = length - size
+        starts = [int(round(i * last / (count - 1))) for i in range(count)]
+        return [(start, start + size) for start in starts]
+
+    def _weights(self, height, width, windows):
+        """Weight of each tile for each of its pixels, summing to one over
+        the frame."""
+        ramps = []
+        total = np.zeros((height, width), np.float32)
+        for y0, y1, x0, x1 in windows:
+            ramp = np.outer(self._ramp(y1 - y0), self._ramp(x1 - x0))
+            ramps.append(ramp)
+            total[y0:y1, x0:x1] += ramp
+        return [
+            (ramp / total[y0:y1, x0:x1])[:, :, np.newaxis]
+            for ramp, (y0, y1, x0, x1) in zip(ramps, windows)
+        ]
+
+    def _ramp(self, length):
+        """Rises over the overlap at each end, from near zero to one."""
+        steps = np.arange(length, dtype=np.float32)
+        distance = np.minimum(steps, length - 1 - steps) + 0.5
+        return np.minimum(distance / self.overlap, 1.0)
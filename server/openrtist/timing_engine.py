@@ -3,8 +3,8 @@ import time
 
 
 class TimingEngine(OpenrtistEngine):
-    def __init__(self, compression_params, adapter):
-        super().__init__(compression_params, adapter)
+    def __init__(self, compression_params, adapter, **kwargs):
+        super().__init__(compression_params, adapter, **kwargs)
         self.count = 0
         self.lasttime = time.time()
         self.lastcount = 0
@@ -13,9 +13,21 @@ class TimingEngine(OpenrtistEngine):
     def handle(self, input_frame):
         self.t0 = time.time()
         result_wrapper = super().handle(input_frame)
+        self._log_timing(1)
+
+        return result_wrapper
+
+    def handle_batch(self, input_frames, client_ids=None):
+        self.t0 = time.time()
+        result_wrappers = super().handle_batch(input_frames, client_ids)
+        self._log_timing(len(input_frames))
+
+        return result_wrappers
+
+    def _log_timing(self, num_frames):
         self.t3 = time.time()
 
-        self.count += 1
+        self.count += num_frames
         if self.t3 - self.lastprint > 5:
             pre = (self.t1 - self.t0) * 1000
             infer = (self.t2 - self.t1) * 1000
@@ -24,7 +36,7 @@ class TimingEngine(OpenrtistEngine):
 
             wait = (self.t0 - self.lasttime) * 1000
             system = pre + infer + post
-            fps = 1.0 / (self.t3 - self.lasttime)
+            fps = num_frames / (self.t3 - self.lasttime)
             avg_fps = (self.count - self.lastcount) / (self.t3 - self.lastprint)
             print("pre {0:.1f} ms, ".format(pre), end="")
             print("infer {0:.1f} ms, ".format(infer), end="")
@@ -40,11 +52,16 @@ class TimingEngine(OpenrtistEngine):
 
         self.lasttime = self.t3
 
-        return result_wrapper
+    def inference(self, preprocessed, style=None):
+        self.t1 = time.time()
+        post_inference = super().inference(preprocessed, style)
+        self.t2 = time.time()
+
+        return post_inference
 
-    def inference(self, preprocessed):
+    def inference_batch(self, preprocessed_batch, style=None):
         self.t1 = time.time()
-        post_inference = super().inference(preprocessed)
+        post_inference = super().inference_batch(preprocessed_batch, style)
         self.t2 = time.time()
 
         return post_inference
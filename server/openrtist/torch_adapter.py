@@ -30,10 +30,14 @@
 # https://github.com/pytorch/examples/blob/master/LICENSE
 
 from openrtist.openrtist_adapter import OpenrtistAdapter
-from torch.autograd import Variable
-from openrtist.transformer_net import TransformerNet
-from torchvision import transforms
+from openrtist.buffer_pool import BufferPool
+from openrtist.stage_pipeline import StagePipeline
+from openrtist.transformer_net import StyleBankTransformerNet, TransformerNet
 from distutils.version import LooseVersion
+from collections import OrderedDict
+import functools
+import threading
+import time
 import numpy as np
 import torch
 import os
@@ -43,55 +47,474 @@ logger = logging.getLogger(__name__)
 
 
 STARTUP_ONES_SIZE = (360, 240, 3)
+DEFAULT_MAX_RESIDENT = 4
+STYLE_BANK = "style_bank.pt"
+
+# Styles whose bfloat16 output is further than this from float32 use float32
+BF16_MIN_PSNR = 40.0
+BF16_CHECK_SIZE = (240, 320, 3)
+
+# Releases before 1.9 only have no_grad
+_inference_mode = getattr(torch, "inference_mode", torch.no_grad)
 
 
 class TorchAdapter(OpenrtistAdapter):
-    def __init__(self, cpu_only, default_style):
+    """Keeps up to max_resident styles loaded as separate networks, so that
+    switching between them does not read weights from disk.
+
+    In eager mode, networks run as they are defined. In script and compile
+    modes, each network is frozen with TorchScript, or compiled with
+    torch.compile, and runs on inputs in channels_last memory format. With
+    bf16 on a CPU that supports it, networks run under bfloat16 autocast,
+    except for styles whose output differs too much from float32. With int8
+    on the CPU, styles that have a <style>.int8.pt model from
+    scripts/freeze_model.py quantize_static run that model instead.
+
+    With uint8_io, networks are wrapped to take uint8 BGR frames in NHWC
+    layout and return the uint8 image to encode in the same layout. The
+    channel swap and scaling are folded into the weights of the first
+    convolution.
+
+    With style_bank, every style is served by the single
+    StyleBankTransformerNet in models/style_bank.pt, which
+    model-app/train_style.py --teachers distills from the separate networks.
+    Frames for different styles can then share a batch, and styles are never
+    loaded or unloaded. The bank does not have an INT8 model.
+
+    With stages, a list of TransformerNet block names, each network is split
+    into stages that start at those blocks, and each stage runs in its own
+    process with stage_threads threads, and with pin_stages, on its own share
+    of the cores that this process may run on. Consecutive frames then overlap in
+    the stages, so that a single stream of frames can use more cores. This
+    needs frames to be in flight together, in a batch or with
+    inference_async. Stages run on the CPU in float32, with float32 inputs
+    and outputs, and not for the style bank.
+
+    Preprocessed frames and batches are written into buffers from a pool,
+    which are reused once inference is done with them. On a GPU, frames are
+    copied through pinned staging buffers.
+
+    num_threads sets the number of threads that Torch uses in this process.
+
+    The default style is run once at each of warmup_sizes, a list of
+    (width, height) pairs, so that the first frames at those sizes are not
+    slow. In script and compile modes, the other styles are then run at the
+    same sizes in a background thread, as many as max_resident allows. A
+    style that was unloaded is compiled again when it is next used."""
+
+    def __init__(
+        self,
+        cpu_only,
+        default_style,
+        max_resident=DEFAULT_MAX_RESIDENT,
+        mode="eager",
+        bf16=False,
+        warmup_sizes=None,
+        int8=False,
+        uint8_io=False,
+        style_bank=False,
+        stages=None,
+        stage_threads=None,
+        pin_stages=False,
+        num_threads=None,
+    ):
         super().__init__(default_style)
+        if stages and (not cpu_only or style_bank):
+            logger.warning("Pipeline stages only run on the CPU without a style bank")
+            stages = None
+        if stages and (bf16 or int8 or uint8_io):
+            logger.warning("Pipeline stages run float32 networks on float32 frames")
+            bf16 = int8 = uint8_io = False
+        self.uint8_io = uint8_io
 
         self.cpu_only = cpu_only
+        self.max_resident = max(1, max_resident)
+
+        if mode == "compile" and not hasattr(torch, "compile"):
+            logger.warning("torch.compile needs Torch 2.0. Using TorchScript")
+            mode = "script"
+        self.mode = mode
+        self.channels_last = mode != "eager" and hasattr(torch, "channels_last")
+
+        self.bf16 = bf16 and cpu_only and _bf16_supported()
+        if bf16 and not self.bf16:
+            logger.warning("bfloat16 is not supported here. Using float32")
+
+        self.int8 = int8 and cpu_only
+        if int8 and not self.int8:
+            logger.warning("INT8 models only run on the CPU. Using float32")
 
         # We do not need to compute gradients. This saves memory.
         torch.set_grad_enabled(False)
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        self._pool = BufferPool(self._allocate)
+        if not cpu_only:
+            self._pinned_pool = BufferPool(
+                lambda shape: torch.empty(shape, dtype=torch.uint8).pin_memory()
+            )
+            self._upload_pool = BufferPool(
+                lambda shape: torch.empty(shape, dtype=torch.uint8, device="cuda")
+            )
 
-        self.style_model = TransformerNet()
+        # Style name -> (network, whether it runs in bfloat16), least
+        # recently used first
+        self._style_models = OrderedDict()
+        self._lock = threading.Lock()
 
         models_dir = "models"
         self.path = os.path.join(os.getcwd(), ".", models_dir)
         # self._update_model_style(default_style)
 
-        self.content_transform = transforms.Compose([transforms.ToTensor()])
+        # (network, whether it runs in bfloat16) for the style bank, and the
+        # index of each style in it
+        self._bank = None
+        self._bank_indices = {}
+        bank_path = os.path.join(self.path, STYLE_BANK)
+        if style_bank and os.path.isfile(bank_path):
+            self._load_bank(bank_path)
+        elif style_bank:
+            logger.warning("No %s. Loading styles separately", STYLE_BANK)
+
+        if self._bank is None:
+            for name in os.listdir(self.path):
+                if name.endswith(".model"):
+                    self.add_supported_style(name[:-6])
 
-        for name in os.listdir(self.path):
-            if name.endswith(".model"):
-                self.add_supported_style(name[:-6])
+        self._pipeline = None
+        if stages:
+            prepare = None
+            if self.mode != "eager":
+                prepare = functools.partial(
+                    _optimize, mode=self.mode, channels_last=self.channels_last
+                )
+            self._pipeline = StagePipeline(
+                self.path,
+                stages,
+                prepare,
+                max_resident=self.max_resident,
+                num_threads=stage_threads,
+                channels_last=self.channels_last,
+                pin=pin_stages,
+            )
 
         # Feed network an array of all ones. This makes it run faster on the
         # first real image.
-        ones = np.ones(STARTUP_ONES_SIZE, np.uint8)
-        preprocessed = self.preprocessing(ones)
-        _ = self.inference(preprocessed)
+        shapes = [STARTUP_ONES_SIZE]
+        if warmup_sizes:
+            shapes = [(height, width, 3) for width, height in warmup_sizes]
+        for shape in shapes:
+            self._run_ones(shape)
 
-    def set_style(self, new_style):
-        if super().set_style(new_style):
-            self._update_model_style(new_style)
+        # Compiling takes a while for each style and size, so the other styles
+        # are compiled in the background too, while they fit
+        if self.mode != "eager" and self._bank is None and self._pipeline is None:
+            styles = [
+                style for style in self.supported_styles if style != self.get_style()
+            ]
+            threading.Thread(
+                target=self._warm, args=(styles, shapes), name="warm", daemon=True
+            ).start()
 
-    def preprocessing(self, img):
-        content_image = self.content_transform(img)
+    def _run_ones(self, shape, style=None):
+        ones = np.ones(shape, np.uint8)
+        preprocessed = self.preprocessing(ones, style)
+        _ = self.inference(preprocessed, style)
+
+    def _warm(self, styles, shapes):
+        """Load styles and run each once at every shape, while there is room
+        for them among the resident styles."""
+        start = time.time()
+        for style in styles:
+            with self._lock:
+                if len(self._style_models) >= self.max_resident:
+                    break
+            try:
+                for shape in shapes:
+                    self._run_ones(shape, style)
+            except Exception:
+                logger.exception("Could not warm up style %s", style)
+        logger.info("Finished warming up styles in %.1f s", time.time() - start)
+
+    def preprocessing(self, img, style=None):
+        frame = torch.from_numpy(img).unsqueeze(0)
+        if not self.cpu_only:
+            frame = self._upload(frame)
+        if self.uint8_io:
+            return frame
+
+        # The same as torchvision's ToTensor
+        content_image = self._pool.acquire((1, 3) + img.shape[:2])
+        torch.div(frame.permute(0, 3, 1, 2), 255, out=content_image)
         if not self.cpu_only:
-            content_image = content_image.cuda()
-        content_image = content_image.unsqueeze(0)
-        return Variable(content_image)
+            self._upload_pool.release(frame)
+        return content_image
+
+    def inference(self, preprocessed, style=None):
+        output = self._forward(style, preprocessed)
+        self._pool.release(preprocessed)
+        return self._output(output)[0]
+
+    def inference_batch(self, preprocessed_batch, style=None):
+        if len(preprocessed_batch) == 1:
+            return [self.inference(preprocessed_batch[0], style)]
+
+        shape = (len(preprocessed_batch),) + tuple(preprocessed_batch[0].shape[1:])
+        batch = self._pool.acquire(shape)
+        torch.cat(preprocessed_batch, out=batch)
+        for preprocessed in preprocessed_batch:
+            self._pool.release(preprocessed)
+        output = self._forward(style, batch)
+        self._pool.release(batch)
+        return list(self._output(output))
+
+    def inference_async(self, preprocessed_batch, callback, style=None, errback=None):
+        if self._pipeline is None:
+            super().inference_async(preprocessed_batch, callback, style, errback)
+            return
 
-    def inference(self, preprocessed):
-        output = self.style_model(preprocessed)
-        return output.data[0].clamp(0, 255).cpu().numpy()
+        style = self._resolve_style(style)
+
+        def finished(outputs):
+            if any(output is None for output in outputs):
+                error = RuntimeError("Pipeline stages could not run " + style)
+                if errback is None:
+                    logger.error("%s", error)
+                else:
+                    errback(error)
+                return
+            callback([np.clip(output, 0, 255, out=output) for output in outputs])
+
+        self._pipeline.run_async(style, preprocessed_batch, finished)
+        for preprocessed in preprocessed_batch:
+            self._pool.release(preprocessed)
 
     def postprocessing(self, post_inference):
+        if self.uint8_io:
+            return post_inference
         return post_inference.transpose(1, 2, 0)
 
-    def _update_model_style(self, new_style):
-        model = os.path.join(self.path, "{}.model".format(new_style))
-        self.style_model.load_state_dict(torch.load(model))
+    def _allocate(self, shape):
+        device = "cpu" if self.cpu_only else "cuda"
+        if self.uint8_io:
+            return torch.empty(shape, dtype=torch.uint8, device=device)
+        if self.channels_last:
+            # HWC frames are already laid out this way
+            return torch.empty(shape, device=device, memory_format=torch.channels_last)
+        return torch.empty(shape, device=device)
+
+    def _upload(self, frame):
+        """Copy frame to the GPU through a pinned buffer."""
+        pinned = self._pinned_pool.acquire(frame.shape)
+        pinned.copy_(frame)
+        pool = self._pool if self.uint8_io else self._upload_pool
+        uploaded = pool.acquire(frame.shape)
+        uploaded.copy_(pinned)
+        self._pinned_pool.release(pinned)
+        return uploaded
+
+    def _output(self, output):
+        """Network output as a numpy array, clipped in place to pixel values
+        unless the network already returns uint8."""
+        if not self.uint8_io:
+            with _inference_mode():
+                output.clamp_(0, 255)
+        return output.cpu().numpy()
+
+    def _forward(self, style, preprocessed):
+        if self._pipeline is not None:
+            style = self._resolve_style(style)
+            return torch.from_numpy(self._pipeline.run(style, preprocessed))
+        if self._bank is not None:
+            return self._forward_bank(style, preprocessed)
+        style_model, bf16 = self._style_model(style)
+        return _run(style_model, preprocessed, bf16)
+
+    def _forward_bank(self, style, preprocessed):
+        styles = style if isinstance(style, list) else [style] * len(preprocessed)
+        style_index = torch.tensor(
+            [self._bank_indices[self._resolve_style(s)] for s in styles]
+        )
+        if not self.cpu_only:
+            style_index = style_index.cuda()
+        bank, bf16 = self._bank
+        return _run(bank, preprocessed, bf16, style_index)
+
+    def _load_bank(self, bank_path):
+        logger.info("Loading %s", bank_path)
+        checkpoint = torch.load(bank_path)
+        styles = checkpoint["styles"]
+        bank = StyleBankTransformerNet(len(styles))
+        bank.load_state_dict(checkpoint["state_dict"])
+        bank.eval()
         if not self.cpu_only:
-            self.style_model.cuda()
+            bank.cuda()
+        if self.uint8_io:
+            bank = _Uint8IOBank(bank)
+        if self.mode != "eager":
+            bank = _optimize(bank, self.mode, self.channels_last)
+
+        bf16 = self.bf16
+        for index, style in enumerate(styles):
+            self._bank_indices[style] = index
+            self.add_supported_style(style)
+            # One style that is too far off keeps the whole bank in float32
+            bf16 = bf16 and _bf16_accurate(style, bank, self.uint8_io, index)
+        self._bank = bank, bf16
+        self.mixed_style_batches = True
+        if self.int8:
+            logger.warning("No INT8 model for the style bank. Using float32")
+
+    def _style_model(self, style):
+        """The network for style, and whether it runs in bfloat16. Frames can
+        come in from several threads, such as with tiles, so a style that is
+        not loaded yet is loaded once while the others wait."""
+        style = self._resolve_style(style)
+        with self._lock:
+            entry = self._style_models.get(style)
+            if entry is not None:
+                self._style_models.move_to_end(style)
+                return entry
+
+            if len(self._style_models) >= self.max_resident:
+                old_style, _ = self._style_models.popitem(last=False)
+                logger.debug("Unloading style %s", old_style)
+
+            if self.int8:
+                int8_model = os.path.join(self.path, "{}.int8.pt".format(style))
+                if os.path.isfile(int8_model):
+                    logger.info("Loading %s", int8_model)
+                    style_model = torch.jit.load(int8_model)
+                    if self.uint8_io:
+                        style_model = _Uint8IO(style_model, fold=False)
+                    entry = style_model, False
+                    self._style_models[style] = entry
+                    return entry
+                logger.warning("No INT8 model for %s. Using float32", style)
+
+            model = os.path.join(self.path, "{}.model".format(style))
+            style_model = TransformerNet()
+            style_model.load_state_dict(torch.load(model))
+            style_model.eval()
+            if not self.cpu_only:
+                style_model.cuda()
+            if self.uint8_io:
+                style_model = _Uint8IO(style_model, fold=True)
+            if self.mode != "eager":
+                style_model = _optimize(style_model, self.mode, self.channels_last)
+
+            entry = style_model, self.bf16 and _bf16_accurate(
+                style, style_model, self.uint8_io
+            )
+            self._style_models[style] = entry
+            return entry
+
+
+class _Uint8IO(torch.nn.Module):
+    """Runs net on uint8 BGR NHWC input and returns uint8 NHWC output,
+    clipped and truncated like the float path.
+
+    With fold, net is a TransformerNet, and the channel swap and scaling of
+    the input are folded into the weights of its first convolution."""
+
+    def __init__(self, net, fold):
+        super().__init__()
+        if fold:
+            conv = net.conv1.conv2d
+            conv.weight.data = conv.weight.data.flip(1) * (1.0 / 255.0)
+        self.net = net
+        self.fold = fold
+        self.eval()
+
+    def forward(self, x):
+        return self._output(self.net(self._input(x)))
+
+    def _input(self, x):
+        x = x.permute(0, 3, 1, 2).float()
+        if not self.fold:
+            x = x.flip(1) * (1.0 / 255.0)
+        return x
+
+    def _output(self, y):
+        y = y.clamp(0, 255).floor()
+        return y.to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+
+
+class _Uint8IOBank(_Uint8IO):
+    """_Uint8IO for a StyleBankTransformerNet"""
+
+    def __init__(self, net):
+        super().__init__(net, fold=True)
+
+    def forward(self, x, style_index):
+        return self._output(self.net(self._input(x), style_index))
+
+
+def _optimize(style_model, mode, channels_last):
+    """Freeze style_model with TorchScript, or compile it in compile mode."""
+    if channels_last:
+        style_model = style_model.to(memory_format=torch.channels_last)
+    if mode == "compile":
+        return torch.compile(style_model)
+
+    style_model = torch.jit.script(style_model)
+    if hasattr(torch.jit, "freeze"):
+        style_model = torch.jit.freeze(style_model)
+    return style_model
+
+
+def _run(style_model, preprocessed, bf16, style_index=None):
+    """Run style_model, passing style_index too if it is a style bank."""
+    inputs = (preprocessed,) if style_index is None else (preprocessed, style_index)
+    with _inference_mode():
+        if not bf16:
+            return style_model(*inputs)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            output = style_model(*inputs)
+        if output.dtype == torch.bfloat16:
+            output = output.float()
+        return output
+
+
+def _bf16_supported():
+    if not hasattr(torch, "autocast"):
+        return False
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def _bf16_accurate(style, style_model, uint8_io, bank_index=None):
+    """Whether style_model gives nearly the same output in bfloat16 as in
+    float32, measured on a smooth random image. For a style bank,
+    bank_index is the index of style in it."""
+    generator = torch.Generator().manual_seed(0)
+    test_image = torch.rand((1, 3, 30, 40), generator=generator)
+    height, width, _ = BF16_CHECK_SIZE
+    test_image = torch.nn.functional.interpolate(
+        test_image, size=(height, width), mode="bilinear", align_corners=False
+    )
+    if uint8_io:
+        test_image = (test_image * 255).to(torch.uint8).permute(0, 2, 3, 1)
+        test_image = test_image.contiguous()
+
+    style_index = None
+    if bank_index is not None:
+        style_index = torch.tensor([bank_index], device=test_image.device)
+
+    expected = _run(style_model, test_image, False, style_index)
+    actual = _run(style_model, test_image, True, style_index)
+    expected = expected.float().clamp(0, 255)
+    actual = actual.float().clamp(0, 255)
+    mse = torch.mean((expected - actual) ** 2).item()
+    psnr = 10 * np.log10(255**2 / max(mse, 1e-10))
+
+    if psnr < BF16_MIN_PSNR:
+        logger.warning(
+            "%s is %.1f dB from float32 in bfloat16. Using float32", style, psnr
+        )
+        return False
+    logger.info("%s is %.1f dB from float32 in bfloat16", style, psnr)
+    return True
@@ -33,6 +33,22 @@
 
 import torch
 
+# The blocks that TransformerNet.forward runs, in order. The network can be
+# split into stages between any two of them
+BLOCKS = (
+    "conv1",
+    "conv2",
+    "conv3",
+    "res1",
+    "res2",
+    "res3",
+    "res4",
+    "res5",
+    "deconv1",
+    "deconv2",
+    "deconv3",
+)
+
 
 class TransformerNet(torch.nn.Module):
     def __init__(self):
@@ -73,6 +89,34 @@ class TransformerNet(torch.nn.Module):
         y = self.deconv3(y)
         return y
 
+    def stages(self, boundaries):
+        """Split the network into torch.nn.Sequential stages that give the
+        same result when run one after the other. A new stage starts at each
+        block named in boundaries."""
+        unknown = set(boundaries) - set(BLOCKS)
+        if unknown:
+            raise ValueError("Unknown blocks: " + ", ".join(sorted(unknown)))
+        starts = sorted(set(BLOCKS.index(name) for name in boundaries))
+        if starts and starts[0] == 0:
+            raise ValueError("The first stage must have at least one block")
+
+        layers = {
+            "conv1": [self.conv1, self.in1, self.relu],
+            "conv2": [self.conv2, self.in2, self.relu],
+            "conv3": [self.conv3, self.in3, self.relu],
+            "deconv1": [self.deconv1, self.in4, self.relu],
+            "deconv2": [self.deconv2, self.in5, self.relu],
+            "deconv3": [self.deconv3],
+        }
+        ends = starts + [len(BLOCKS)]
+        stages = []
+        for start, end in zip([0] + starts, ends):
+            modules = []
+            for name in BLOCKS[start:end]:
+                modules.extend(layers.get(name, [getattr(self, name)]))
+            stages.append(torch.nn.Sequential(*modules).train(self.training))
+        return stages
+
 
 class ConvLayer(torch.nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride):
@@ -130,3 +174,96 @@ class UpsampleConvLayer(torch.nn.Module):
         out = self.reflection_pad(x_in)
         out = self.conv2d(out)
         return out
+
+
+class StyleBankTransformerNet(torch.nn.Module):
+    """TransformerNet for num_styles styles that share every convolution.
+
+    Only the affine parameters of the instance norms belong to a style. Each
+    sample in a batch is stylized with the style at its entry of style_index,
+    so one batch can mix styles."""
+
+    def __init__(self, num_styles):
+        super(StyleBankTransformerNet, self).__init__()
+        self.num_styles = num_styles
+        # Initial convolution layers
+        self.conv1 = ConvLayer(3, 32, kernel_size=9, stride=1)
+        self.in1 = ConditionalInstanceNorm2d(32, num_styles)
+        self.conv2 = ConvLayer(32, 64, kernel_size=3, stride=2)
+        self.in2 = ConditionalInstanceNorm2d(64, num_styles)
+        self.conv3 = ConvLayer(64, 128, kernel_size=3, stride=2)
+        self.in3 = ConditionalInstanceNorm2d(128, num_styles)
+        # Residual layers
+        self.res1 = ConditionalResidualBlock(128, num_styles)
+        self.res2 = ConditionalResidualBlock(128, num_styles)
+        self.res3 = ConditionalResidualBlock(128, num_styles)
+        self.res4 = ConditionalResidualBlock(128, num_styles)
+        self.res5 = ConditionalResidualBlock(128, num_styles)
+        # Upsampling Layers
+        self.deconv1 = UpsampleConvLayer(128, 64, kernel_size=3, stride=1, upsample=2)
+        self.in4 = ConditionalInstanceNorm2d(64, num_styles)
+        self.deconv2 = UpsampleConvLayer(64, 32, kernel_size=3, stride=1, upsample=2)
+        self.in5 = ConditionalInstanceNorm2d(32, num_styles)
+        self.deconv3 = ConvLayer(32, 3, kernel_size=9, stride=1)
+        # Non-linearities
+        self.relu = torch.nn.ReLU()
+
+    def forward(self, X, style_index):
+        y = self.relu(self.in1(self.conv1(X), style_index))
+        y = self.relu(self.in2(self.conv2(y), style_index))
+        y = self.relu(self.in3(self.conv3(y), style_index))
+        y = self.res1(y, style_index)
+        y = self.res2(y, style_index)
+        y = self.res3(y, style_index)
+        y = self.res4(y, style_index)
+        y = self.res5(y, style_index)
+        y = self.relu(self.in4(self.deconv1(y), style_index))
+        y = self.relu(self.in5(self.deconv2(y), style_index))
+        y = self.deconv3(y)
+        return y
+
+    def load_transformer_nets(self, state_dicts):
+        """Take the instance norm parameters of each style from the state
+        dict of its TransformerNet, and the convolutions from the first."""
+        own_state = self.state_dict()
+        for name, value in state_dicts[0].items():
+            if name in own_state and own_state[name].shape == value.shape:
+                own_state[name].copy_(value)
+        for index, state_dict in enumerate(state_dicts):
+            for name, value in state_dict.items():
+                if name in own_state and own_state[name].dim() == 2:
+                    own_state[name][index].copy_(value)
+
+
+class ConditionalInstanceNorm2d(torch.nn.Module):
+    """InstanceNorm2d with one set of affine parameters per style."""
+
+    def __init__(self, num_features, num_styles):
+        super(ConditionalInstanceNorm2d, self).__init__()
+        self.weight = torch.nn.Parameter(torch.ones(num_styles, num_features))
+        self.bias = torch.nn.Parameter(torch.zeros(num_styles, num_features))
+
+    def forward(self, x, style_index):
+        out = torch.nn.functional.instance_norm(x)
+        weight = self.weight[style_index].unsqueeze(2).unsqueeze(3)
+        bias = self.bias[style_index].unsqueeze(2).unsqueeze(3)
+        return out * weight + bias
+
+
+class ConditionalResidualBlock(torch.nn.Module):
+    """ResidualBlock with ConditionalInstanceNorm2d"""
+
+    def __init__(self, channels, num_styles):
+        super(ConditionalResidualBlock, self).__init__()
+        self.conv1 = ConvLayer(channels, channels, kernel_size=3, stride=1)
+        self.in1 = ConditionalInstanceNorm2d(channels, num_styles)
+        self.conv2 = ConvLayer(channels, channels, kernel_size=3, stride=1)
+        self.in2 = ConditionalInstanceNorm2d(channels, num_styles)
+        self.relu = torch.nn.ReLU()
+
+    def forward(self, x, style_index):
+        residual = x
+        out = self.relu(self.in1(self.conv1(x), style_index))
+        out = self.in2(self.conv2(out), style_index)
+        out = out + residual
+        return out